@@ -0,0 +1,121 @@
+import hashlib
+import os
+
+import numpy as np
+from sklearn.manifold import TSNE
+from sklearn.decomposition import PCA, IncrementalPCA
+from sklearn.neighbors import NearestNeighbors
+
+from atomic_files import read_npz, write_npz
+
+# t-SNE and PCA embeddings of the color histograms, stored next to the feature store and reused at the next start.
+# If only a few images were added, they are placed into the stored layouts instead of refitting: with the stored PCA
+# projection and between their nearest neighbours in the t-SNE layout. Otherwise t-SNE is refitted, starting from
+# the previous layout, so the picture stays recognizable.
+# Before t-SNE, the 4096 dimensional color histograms are reduced with a PCA, which makes t-SNE much cheaper for
+# large image collections.
+
+# File of the embedding store
+EMBEDDING_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "embeddings.npz")
+
+# Up to this fraction of new images, the new images are placed into the stored layouts instead of refitting
+MAX_PLACED_FRACTION = 0.1
+
+# Number of PCA components t-SNE runs on, None runs t-SNE on the full color histograms
+PRE_REDUCTION = 50
+
+# Number of nearest stored images a new image is placed between in the t-SNE layout
+N_NEIGHBORS = 5
+
+
+# digest of every feature row, so modified images with an unchanged path are recognized
+def _row_digests(H):
+    return [hashlib.sha1(np.ascontiguousarray(row).tobytes()).hexdigest() for row in H]
+
+
+def _write_store(cache_file, paths, digests, tsne_im, reduced, pca_mean, pca_components):
+    write_npz(cache_file, paths=np.array(paths, dtype=str), digests=np.array(digests, dtype=str), tsne=tsne_im,
+              reduced=reduced, pca_mean=pca_mean, pca_components=pca_components)
+
+
+# place new images in a stored t-SNE layout, at the distance weighted mean of their nearest stored images
+def _place(H_new, H_known, layout_known):
+    n_neighbors = min(N_NEIGHBORS, len(H_known))
+    distances, neighbors = NearestNeighbors(n_neighbors=n_neighbors).fit(H_known).kneighbors(H_new)
+    weights = 1 / np.maximum(distances, 1e-12)
+    weights /= np.sum(weights, axis=1, keepdims=True)
+    return np.einsum('ij,ijk->ik', weights, layout_known[neighbors])
+
+
+# Projection to the PCA view while the images are still being loaded: the stored PCA if there is one, otherwise an
+# IncrementalPCA that is updated with every batch. The final view is computed by compute_embeddings.
+class ProgressivePCA:
+    def __init__(self, cache_file=EMBEDDING_FILE):
+        store = read_npz(cache_file)
+        self.incremental = None
+        if store is not None and 'pca_mean' in store:
+            self.mean, self.components = store['pca_mean'], store['pca_components'][:2]
+        else:
+            self.incremental = IncrementalPCA(n_components=2)
+
+    def project(self, H):
+        if self.incremental is None:
+            return (H - self.mean) @ self.components.T
+        # every partial fit needs at least as many images as components
+        if len(H) >= 2:
+            self.incremental.partial_fit(H)
+        if not hasattr(self.incremental, 'components_'):
+            return np.zeros(shape=(len(H), 2))
+        return self.incremental.transform(H)
+
+
+# compute the t-SNE and PCA embeddings of the color histograms, reusing the stored embeddings where possible
+# references:
+# https://scikit-learn.org/stable/modules/generated/sklearn.manifold.TSNE.html
+# https://scikit-learn.org/stable/modules/generated/sklearn.decomposition.PCA.html
+def compute_embeddings(paths, H_color_arr, cache_file=EMBEDDING_FILE):
+    n = len(paths)
+    digests = _row_digests(H_color_arr)
+    # The PCA keeps PRE_REDUCTION components, its first two are the PCA view and all of them are the t-SNE input
+    n_components = 2 if PRE_REDUCTION is None else max(2, min(PRE_REDUCTION, n, H_color_arr.shape[1]))
+
+    store = read_npz(cache_file)
+    rows = [None] * n
+    if store is not None and 'reduced' in store and store['reduced'].shape[1] == n_components:
+        index = {key: row for row, key in enumerate(zip(store['paths'].tolist(), store['digests'].tolist()))}
+        rows = [index.get(key) for key in zip(paths, digests)]
+    known = [idx for idx, row in enumerate(rows) if row is not None]
+    new = [idx for idx, row in enumerate(rows) if row is None]
+    known_rows = [rows[idx] for idx in known]
+
+    # Nothing changed, use the stored embeddings
+    if known and not new and len(known) == len(store['paths']):
+        return store['tsne'][known_rows], store['reduced'][known_rows, :2]
+
+    tsne_im = np.empty(shape=(n, 2))
+    reduced = np.empty(shape=(n, n_components), dtype=np.float32)
+    if known:
+        # Project the new images with the stored PCA and place them between their neighbours in the t-SNE layout
+        pca_mean, pca_components = store['pca_mean'], store['pca_components']
+        tsne_im[known] = store['tsne'][known_rows]
+        reduced[known] = store['reduced'][known_rows]
+        if new:
+            reduced[new] = (H_color_arr[new] - pca_mean) @ pca_components.T
+            tsne_input = reduced if PRE_REDUCTION is not None else H_color_arr
+            tsne_im[new] = _place(tsne_input[new], tsne_input[known], tsne_im[known])
+
+    # With many new images, refit the PCA and t-SNE, the latter starting from the previous layout
+    if not known or len(new) > MAX_PLACED_FRACTION * n:
+        pca = PCA(n_components=n_components)
+        reduced = pca.fit_transform(H_color_arr).astype(np.float32)
+        pca_mean, pca_components = pca.mean_, pca.components_
+        tsne_input = reduced if PRE_REDUCTION is not None else H_color_arr
+        if known:
+            # scaled like the PCA initialization of scikit-learn
+            init = tsne_im / (np.std(tsne_im[:, 0]) or 1) * 1e-4
+            tsne_im = TSNE(n_components=2, init=init).fit_transform(tsne_input)
+        else:
+            tsne_im = TSNE(n_components=2).fit_transform(tsne_input)
+
+    _write_store(cache_file, paths, digests, tsne_im, reduced, pca_mean, pca_components)
+    return tsne_im, reduced[:, :2]
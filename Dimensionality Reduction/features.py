@@ -0,0 +1,211 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+
+from atomic_files import read_npz, write_npz
+
+# Feature extraction for the dimensionality reduction app: a 3D color histogram and three channel histograms per
+# image. The images are processed in chunks by a process pool, and the workers write their rows directly into the
+# shared memory buffers behind H_color_arr and H_channel_arr. The histograms are kept in a feature store on disk, so
+# only new or modified images have to be processed when the server is restarted. The color histograms are stored as
+# float32, which halves their memory and is exact for up to 2^24 pixels per bin.
+
+# Number of bins per color for the 3D color histograms
+N_BINS_COLOR = 16
+# Number of bins per channel for the channel histograms
+N_BINS_CHANNEL = 50
+
+# Number of images handed to a worker process at once
+CHUNK_SIZE = 16
+
+# Start method of the worker processes. The pipeline runs in a thread of the Bokeh server, so the workers are started
+# by a fork server (or spawned where there is none) instead of forking the multi-threaded server process
+MP_CONTEXT = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+                                         else 'spawn')
+
+# Folder of the app and its modules
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# File of the feature store, next to main.py and not inside the static folder, which is served to the browser
+CACHE_FILE = os.path.join(APP_DIR, "cache", "features.npz")
+
+
+# bin of every possible 8 bit value for n_bins equal bins over range=(0, 255). The edges are the same as the ones
+# used by np.histogram and np.histogramdd: every bin is half open except the last one, which also includes 255
+def _bin_lookup(n_bins):
+    edges = np.linspace(0, 255, n_bins + 1)
+    return np.minimum(np.searchsorted(edges, np.arange(256), side='right') - 1, n_bins - 1)
+
+
+# Lookup tables from a channel value to its share of the flat color histogram index and to its channel histogram bin
+COLOR_LOOKUP_R = (_bin_lookup(N_BINS_COLOR) * N_BINS_COLOR**2).astype(np.uint16)
+COLOR_LOOKUP_G = (_bin_lookup(N_BINS_COLOR) * N_BINS_COLOR).astype(np.uint16)
+COLOR_LOOKUP_B = _bin_lookup(N_BINS_COLOR).astype(np.uint16)
+CHANNEL_LOOKUP = _bin_lookup(N_BINS_CHANNEL)
+
+
+# compute the color and channel histograms of an (N_Pixel, 3) uint8 pixel array. Every pixel is quantized once through
+# the lookup tables and all histograms are counted with np.bincount, which gives the same counts as
+# np.histogramdd(np_im, bins=N_BINS_COLOR, range=((0,255),(0,255),(0,255))) flattened in C order and as
+# np.histogram(np_im[:, channel], bins=N_BINS_CHANNEL, range=(0, 255)) for every channel
+def pixel_histograms(np_im):
+    r, g, b = np_im[:, 0], np_im[:, 1], np_im[:, 2]
+
+    color_index = COLOR_LOOKUP_R[r] + COLOR_LOOKUP_G[g] + COLOR_LOOKUP_B[b]
+    H_color = np.bincount(color_index, minlength=N_BINS_COLOR**3)
+
+    # The channel histograms are folded from the counts of the 256 possible values of each channel
+    H_channel = np.empty(shape=(3,N_BINS_CHANNEL))
+    for channel, values in enumerate((r, g, b)):
+        H_channel[channel] = np.bincount(CHANNEL_LOOKUP, weights=np.bincount(values, minlength=256),
+                                         minlength=N_BINS_CHANNEL)
+
+    return H_color, H_channel
+
+
+# compute the color and channel histograms of one image
+def image_histograms(f):
+    # open image using PILs Image package
+    im = Image.open(f)
+
+    # Convert the image into a uint8 array and reshape it such that we have an array with the dimensions (N_Pixel, 3)
+    np_im = np.asarray(im.convert('RGB'), dtype=np.uint8)
+    N_Pixel = np_im.shape[0]*np_im.shape[1]
+    np_im = np.reshape(np_im, (N_Pixel, 3))
+
+    return pixel_histograms(np_im)
+
+
+# worker of the process pool: compute the histograms of a chunk of images and write them into the shared buffers
+def _extract_chunk(start, paths, color_name, channel_name, n):
+    color_shm = shared_memory.SharedMemory(name=color_name)
+    channel_shm = shared_memory.SharedMemory(name=channel_name)
+    try:
+        H_color_arr = np.ndarray((n, N_BINS_COLOR**3), dtype=np.float32, buffer=color_shm.buf)
+        H_channel_arr = np.ndarray((n, 3, N_BINS_CHANNEL), dtype=np.float64, buffer=channel_shm.buf)
+        for idx, f in enumerate(paths, start):
+            H_color_arr[idx], H_channel_arr[idx] = image_histograms(f)
+        del H_color_arr, H_channel_arr
+    finally:
+        color_shm.close()
+        channel_shm.close()
+
+
+# a process pool for the histograms and thumbnails. The workers import the modules of the app with the sys.path of the
+# server at the time they start, see server_lifecycle.py
+def worker_pool(max_workers=None):
+    return ProcessPoolExecutor(max_workers, mp_context=MP_CONTEXT)
+
+
+def _extract_chunks(pool, paths, color_shm, channel_shm):
+    n = len(paths)
+    futures = [pool.submit(_extract_chunk, start, paths[start:start + CHUNK_SIZE], color_shm.name, channel_shm.name, n)
+               for start in range(0, n, CHUNK_SIZE)]
+    for future in futures:
+        future.result()
+
+
+# compute the histograms of all images, returns the N x N_BINS_COLOR^3 color histograms and the N x 3 x N_BINS_CHANNEL
+# channel histograms in the order of paths. The chunks are processed in pool, a process pool from worker_pool, or in
+# a pool of max_workers processes that is started for this call
+def extract_features(paths, max_workers=None, pool=None):
+    n = len(paths)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = min(max_workers, -(-n // CHUNK_SIZE))
+
+    if max_workers <= 1:
+        H_color_arr = np.empty(shape=(n, N_BINS_COLOR**3), dtype=np.float32)
+        H_channel_arr = np.empty(shape=(n, 3, N_BINS_CHANNEL))
+        for idx, f in enumerate(paths):
+            H_color_arr[idx], H_channel_arr[idx] = image_histograms(f)
+        return H_color_arr, H_channel_arr
+
+    # Preallocate the output arrays in shared memory so the workers do not have to send their results back
+    color_shm = shared_memory.SharedMemory(create=True, size=n * N_BINS_COLOR**3 * 4)
+    channel_shm = shared_memory.SharedMemory(create=True, size=n * 3 * N_BINS_CHANNEL * 8)
+    try:
+        if pool is None:
+            with worker_pool(max_workers) as own_pool:
+                _extract_chunks(own_pool, paths, color_shm, channel_shm)
+        else:
+            _extract_chunks(pool, paths, color_shm, channel_shm)
+        H_color_arr = np.ndarray((n, N_BINS_COLOR**3), dtype=np.float32, buffer=color_shm.buf).copy()
+        H_channel_arr = np.ndarray((n, 3, N_BINS_CHANNEL), dtype=np.float64, buffer=channel_shm.buf).copy()
+    finally:
+        color_shm.close()
+        color_shm.unlink()
+        channel_shm.close()
+        channel_shm.unlink()
+
+    return H_color_arr, H_channel_arr
+
+
+# read the feature store, returns the identifying keys (path, size, mtime) of the stored images and their histograms,
+# or None if there is no usable store
+def _read_store(cache_file):
+    store = read_npz(cache_file)
+    if store is None or not {'paths', 'sizes', 'mtimes', 'H_color', 'H_channel'} <= store.keys():
+        return None
+    keys = list(zip(store['paths'].tolist(), store['sizes'].tolist(), store['mtimes'].tolist()))
+    return keys, store['H_color'], store['H_channel']
+
+
+def _write_store(cache_file, paths, sizes, mtimes, H_color_arr, H_channel_arr):
+    write_npz(cache_file, paths=np.array(paths, dtype=str), sizes=sizes, mtimes=mtimes,
+              H_color=H_color_arr, H_channel=H_channel_arr)
+
+
+# load the histograms of all images from the feature store and only compute them for new or modified images.
+# An image is identified by its path, size and modification time, images that no longer exist are dropped from the
+# store. Returns the histograms in the order of paths, like extract_features.
+# If on_batch is given, it is called with the indices into paths and the histograms of every batch of at most
+# batch_size images as soon as they are available, first for the stored images and then for the computed ones
+def load_features(paths, cache_file=CACHE_FILE, max_workers=None, on_batch=None, batch_size=None, pool=None):
+    n = len(paths)
+    stats = [os.stat(f) for f in paths]
+    sizes = np.array([st.st_size for st in stats], dtype=np.int64)
+    mtimes = np.array([st.st_mtime_ns for st in stats], dtype=np.int64)
+
+    H_color_arr = np.empty(shape=(n, N_BINS_COLOR**3), dtype=np.float32)
+    H_channel_arr = np.empty(shape=(n, 3, N_BINS_CHANNEL))
+    cached = []
+    missing = list(range(n))
+    changed = True
+
+    store = _read_store(cache_file)
+    if store is not None:
+        keys, H_color_store, H_channel_store = store
+        index = {key: row for row, key in enumerate(keys)}
+        rows = [index.get(key) for key in zip(paths, sizes.tolist(), mtimes.tolist())]
+        cached = [idx for idx, row in enumerate(rows) if row is not None]
+        if cached:
+            H_color_arr[cached] = H_color_store[[rows[idx] for idx in cached]]
+            H_channel_arr[cached] = H_channel_store[[rows[idx] for idx in cached]]
+        missing = [idx for idx, row in enumerate(rows) if row is None]
+        changed = bool(missing) or len(cached) != len(keys)
+
+    if batch_size is None:
+        batch_size = max(n, 1)
+    if on_batch is not None:
+        for start in range(0, len(cached), batch_size):
+            batch = cached[start:start + batch_size]
+            on_batch(batch, H_color_arr[batch], H_channel_arr[batch])
+
+    # Only the new or modified images go through the histogram code
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        H_color_new, H_channel_new = extract_features([paths[idx] for idx in batch], max_workers, pool)
+        H_color_arr[batch] = H_color_new
+        H_channel_arr[batch] = H_channel_new
+        if on_batch is not None:
+            on_batch(batch, H_color_new, H_channel_new)
+
+    if changed:
+        _write_store(cache_file, paths, sizes, mtimes, H_color_arr, H_channel_arr)
+
+    return H_color_arr, H_channel_arr
@@ -1,26 +1,23 @@
-import glob
-import os
 import numpy as np
-from PIL import Image
-
-from sklearn.manifold import TSNE
-from sklearn.decomposition import PCA
 
 from bokeh.plotting import figure, curdoc
-from bokeh.models import ColumnDataSource
+from bokeh.models import ColumnDataSource, Div
 from bokeh.layouts import layout
 
+import pipeline
+from features import N_BINS_CHANNEL
+
 # Dependencies
 # Make sure to install the additional dependencies noted in the requirements.txt using the following command:
 # pip install -r requirements.txt
 
 # You might want to implement a helper function for the update function below or you can do all the calculations in the
 # update callback function.
-def helper(rows):
+# The helper gets the channel histograms already aggregated over the selected rows, see update
+def helper(aggr_H):
 
-    H_channel_row = H_channel_arr[rows, :, :]
-    aggr_H = np.sum(H_channel_row, axis=0)
-    aggr_H_channel = np.sum(aggr_H, axis=1)
+    # no division by zero while no image is loaded yet
+    aggr_H_channel = np.maximum(np.sum(aggr_H, axis=1), 1)
     # I have decided to simply calculate the relative frequency of the pixels per channel, without normalizing to 1.
     # I hope that this is OK, in my opinion this makes the channel histogram more interpretable, as a histogram is
     # usually used to visualize a distribution, and the area under the distribution always sums up to 1.
@@ -42,21 +39,60 @@ def helper(rows):
 # https://docs.bokeh.org/en/latest/docs/reference/models/sources.html
 # https://docs.bokeh.org/en/latest/docs/reference/models/tools.html
 # https://docs.bokeh.org/en/latest/docs/reference/models/selections.html#bokeh.models.selections.Selection
+# The aggregate of the selection is maintained incrementally: only the rows that entered or left the selection since
+# the last event are added or subtracted, unless recomputing the whole selection is cheaper.
 def update(attr, old, new):
-    selected_rows = new
-
-    # we don't want to do anything if nothing is selected
+    global selected_rows, selected_aggr_H
+    new_rows = set(new)
+    added = list(new_rows - selected_rows)
+    removed = list(selected_rows - new_rows)
+    if len(added) + len(removed) < len(new_rows):
+        selected_aggr_H = (selected_aggr_H + np.sum(H_channel_arr[added], axis=0)
+                           - np.sum(H_channel_arr[removed], axis=0))
+    else:
+        selected_aggr_H = np.sum(H_channel_arr[list(new_rows)], axis=0)
+    selected_rows = new_rows
+
+    # we don't want to do anything if nothing is selected, then the precomputed histogram of all loaded images is shown
     if len(selected_rows) == 0:
-        Frequency_r,Frequency_g,Frequency_b = helper(np.arange(N))
-        source_channel.data = dict(
-            bin=bin,
-            Frequency_r=Frequency_r,
-            Frequency_g=Frequency_g,
-            Frequency_b=Frequency_b
-        )
-        return
-
-    Frequency_r, Frequency_g, Frequency_b = helper(selected_rows)
+        update_channel_histogram(H_channel_total)
+    else:
+        update_channel_histogram(selected_aggr_H)
+
+
+# stream the images the pipeline loaded since the last call into the plots, and show the t-SNE layout and the final
+# PCA view once they are finished
+def poll_pipeline():
+    global n_streamed, H_channel_total
+    n_loaded = state.n_loaded
+    if n_loaded > n_streamed:
+        source.stream(state.columns(n_streamed, n_loaded))
+        H_channel_total = H_channel_total + np.sum(H_channel_arr[n_streamed:n_loaded], axis=0)
+        n_streamed = n_loaded
+        if len(selected_rows) == 0:
+            update_channel_histogram(H_channel_total)
+
+    if state.done and n_streamed == state.N:
+        final = state.columns(0, state.N)
+        source.patch({column: [(slice(0, state.N), final[column].tolist())]
+                      for column in ['tsne_x', 'tsne_y', 'pca_x', 'pca_y']})
+    if state.error is not None:
+        show_error()
+    if (state.done and n_streamed == state.N) or state.error is not None:
+        doc.remove_periodic_callback(poll_callback)
+
+
+# the pipeline failed, the images are processed again at its next refresh, see pipeline.refresh_in_background
+def show_error():
+    if pipeline.REFRESH_INTERVAL is None:
+        status.text = "Processing the images failed: {}. Restart the server to retry.".format(state.error)
+    else:
+        status.text = "Processing the images failed: {}. The images are processed again in the background, reload " \
+                      "the page in a while.".format(state.error)
+
+
+def update_channel_histogram(aggr_H):
+    Frequency_r, Frequency_g, Frequency_b = helper(aggr_H)
     source_channel.data = dict(
         bin=bin,
         Frequency_r=Frequency_r,
@@ -65,83 +101,19 @@ def update(attr, old, new):
     )
 
 
-# Fetch the number of images using glob or some other path analyzer
-N = len(glob.glob("static/*.jpg"))
-
-# Find the root directory of your app to generate the image URL for the bokeh server
-ROOT = os.path.split(os.path.abspath("."))[1] + "/"
-
-# Number of bins per color for the 3D color histograms
-N_BINS_COLOR = 16
-# Number of bins per channel for the channel histograms
-N_BINS_CHANNEL = 50
-
-# Define an array containing the 3D color histograms. We have one histogram per image each having N_BINS_COLOR^3 bins.
-# i.e. an N * N_BINS_COLOR^3 array
-H_color_arr = np.empty(shape=(N,N_BINS_COLOR**3))
-
-# Define an array containing the channel histograms, there is one per image each having 3 channel and N_BINS_CHANNEL
-# bins i.e an N x 3 x N_BINS_CHANNEL array
-H_channel_arr = np.empty(shape=(N,3,N_BINS_CHANNEL))
-
-# initialize an empty list for the image file paths
-im_arr = []
-
-
-# Compute the color and channel histograms
-for idx, f in enumerate(glob.glob("static/*.jpg")):
-    # open image using PILs Image package
-    im = Image.open(f)
+# The features, embeddings and thumbnails are computed once per server process, see pipeline.py and
+# server_lifecycle.py. The session comes up right away with the images loaded so far, the rest is streamed in by
+# poll_pipeline. Every session gets the same read-only arrays.
+state = pipeline.get_state()
+H_channel_arr = state.H_channel_arr
+h, w = state.h, state.w
+n_streamed = state.n_loaded
 
-    # Convert the image into a numpy array and reshape it such that we have an array with the dimensions (N_Pixel, 3)
-    np_im = np.array(im)
-    N_Pixel = np_im.shape[0]*np_im.shape[1]
-    np_im = np.reshape(np_im, (N_Pixel, 3))
-
-    # Compute a multi dimensional histogram for the pixels, which returns a cube
-    # reference: https://numpy.org/doc/stable/reference/generated/numpy.histogramdd.html
-    H_im, edges = np.histogramdd(np_im, bins=N_BINS_COLOR, range = ((0,255),(0,255),(0,255)))
-
-    # However, later used methods do not accept multi dimensional arrays, so reshape it to only have columns and rows
-    # (N_Images, N_BINS^3) and add it to the color_histograms array you defined earlier
-    # reference: https://numpy.org/doc/stable/reference/generated/numpy.reshape.html
-    H_im = np.reshape(H_im, (1,N_BINS_COLOR**3))
-    H_color_arr[idx] = H_im
-
-    # Append the image url to the list for the server
-    url = ROOT + f
-    im_arr.append(url)
-
-    # Compute a "normal" histogram for each color channel (rgb)
-    # reference: https://numpy.org/doc/stable/reference/generated/numpy.histogram.html
-    H_r_im, edges_r = np.histogram(np_im[:,0], bins = N_BINS_CHANNEL,range = (0,255))
-    H_g_im, edges_g = np.histogram(np_im[:, 1], bins=N_BINS_CHANNEL, range=(0, 255))
-    H_b_im, edges_b = np.histogram(np_im[:, 2], bins=N_BINS_CHANNEL, range=(0, 255))
-
-    # and add them to the channel_histograms
-    H_channel_arr[idx][0] = H_r_im
-    H_channel_arr[idx][1] = H_g_im
-    H_channel_arr[idx][2] = H_b_im
-
-# Get get the initial shape of the image, to make sure the aspect is not skewed
-img = np.array(Image.open(f))
-h, w = img.shape[:2]
-
-# Calculate the indicated dimensionality reductions
-# references:
-# https://scikit-learn.org/stable/modules/generated/sklearn.manifold.TSNE.html
-# https://scikit-learn.org/stable/modules/generated/sklearn.decomposition.PCA.html
-tsne_im = TSNE(n_components=2).fit_transform(H_color_arr)
-pca_im = PCA(n_components=2).fit_transform(H_color_arr)
+# Milliseconds between two checks for newly loaded images
+POLL_INTERVAL = 250
 
 # Construct a data source containing the dimensional reduction result for both the t-SNE and the PCA and the image paths
-source_dict = {'image':im_arr,
-               'tsne_x':tsne_im[:,0].tolist(),
-               'tsne_y':tsne_im[:,1].tolist(),
-               'pca_x':pca_im[:,0].tolist(),
-               'pca_y':pca_im[:,1].tolist()
-               }
-source = ColumnDataSource(data=source_dict)
+source = ColumnDataSource(data=state.columns(0, n_streamed))
 
 # Create a first figure for the t-SNE data. Add the lasso_select, wheel_zoom, pan and reset tools to it.
 plot_1 = figure(x_axis_label='x', y_axis_label='y',
@@ -169,7 +141,13 @@ plot_2.circle('pca_x','pca_y',alpha = 0,source=source)
 # Construct a datasource containing the channel histogram data. Default value should be the selection of all images.
 # Think about how you aggregate the histogram data of all images to construct this data source
 bin = list(range(1,N_BINS_CHANNEL+1))
-Frequency_r,Frequency_g,Frequency_b = helper(np.arange(N))
+H_channel_total = np.sum(H_channel_arr[:n_streamed], axis=0)
+Frequency_r,Frequency_g,Frequency_b = helper(H_channel_total)
+
+# The currently selected rows and their aggregated channel histograms, maintained by update
+selected_rows = set()
+selected_aggr_H = np.zeros(shape=(3,N_BINS_CHANNEL))
+
 source_dict_channel = {'bin':bin,
                        'Frequency_r':Frequency_r,
                        'Frequency_g':Frequency_g,
@@ -190,9 +168,19 @@ plot_3.line("bin", "Frequency_b", line_width=3,color="blue", source=source_chann
 # callback/update function to recompute the channel histogram. Also read the topmost comment for more information.
 source.selected.on_change("indices", update)
 
+# A DIV element for errors of the pipeline
+status = Div(text="", sizing_mode="stretch_width")
+
 # Construct a layout and use curdoc() to add it to your document.
-lt = layout([[plot_1, plot_2, plot_3]], sizing_mode="stretch_width")
-curdoc().add_root(lt)
+lt = layout([[status], [plot_1, plot_2, plot_3]], sizing_mode="stretch_width")
+doc = curdoc()
+doc.add_root(lt)
+
+# Keep streaming images until the pipeline is finished
+if state.error is not None:
+    show_error()
+elif not (state.done and n_streamed == state.N):
+    poll_callback = doc.add_periodic_callback(poll_pipeline, POLL_INTERVAL)
 
 
 # You can use the command below in the folder of your python file to start a bokeh directory app.
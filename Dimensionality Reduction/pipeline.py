@@ -0,0 +1,173 @@
+import glob
+import os
+import threading
+import weakref
+
+import numpy as np
+from PIL import Image
+
+from features import N_BINS_COLOR, N_BINS_CHANNEL, load_features, worker_pool
+from embedding import ProgressivePCA, compute_embeddings
+from thumbnails import make_thumbnails, remove_stale_thumbnails
+
+# The heavy part of the app: feature extraction, dimensionality reduction and thumbnails. Bokeh executes main.py again
+# for every browser session, so this runs once per server process instead, in a background thread started by
+# on_server_loaded in server_lifecycle.py. The images are processed in batches and every finished batch is published
+# in the shared state, with a preliminary PCA projection, so the sessions can stream them into their plots. The t-SNE
+# layout and the final PCA view follow once all images are loaded.
+
+# Directory of the app, all files are looked up relative to it and not to the working directory of the server
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Find the root directory of your app to generate the image URL for the bokeh server
+ROOT = os.path.basename(APP_DIR) + "/"
+
+# Number of images per published batch
+BATCH_SIZE = 128
+
+# Seconds between two checks of the static folder for added, modified or deleted images, None disables the refresh
+REFRESH_INTERVAL = 30
+
+
+# The result of the pipeline that is shared by all sessions. The rows are in the order in which the images were
+# loaded, the first n_loaded rows are complete. The pipeline thread fills the arrays, the sessions only get read-only
+# views of them.
+class PipelineState:
+    def __init__(self, paths, signature):
+        self.signature = signature
+        self.N = len(paths)
+        self.n_loaded = 0
+        self.done = False
+        self.error = None
+
+        self.image = [None] * self.N
+        self.thumbnails = []
+        self._H_channel_arr = np.zeros(shape=(self.N, 3, N_BINS_CHANNEL))
+        self._pca = np.full(shape=(self.N, 2), fill_value=np.nan)
+        self._tsne = np.full(shape=(self.N, 2), fill_value=np.nan)
+        self.H_channel_arr = _read_only(self._H_channel_arr)
+        self.pca = _read_only(self._pca)
+        self.tsne = _read_only(self._tsne)
+
+        # Get get the initial shape of the image, to make sure the aspect is not skewed. Only the header is read.
+        w, h = Image.open(paths[-1]).size if paths else (1, 1)
+        self.h, self.w = h, w
+
+    # column data of the rows start to stop for the data source of a session, the t-SNE coordinates are NaN and thus
+    # not drawn until the t-SNE layout is finished
+    def columns(self, start, stop):
+        return {'image': self.image[start:stop],
+                'tsne_x': self.tsne[start:stop, 0].copy(),
+                'tsne_y': self.tsne[start:stop, 1].copy(),
+                'pca_x': self.pca[start:stop, 0].copy(),
+                'pca_y': self.pca[start:stop, 1].copy()
+                }
+
+
+def _read_only(arr):
+    view = arr.view()
+    view.setflags(write=False)
+    return view
+
+
+_state = None
+_lock = threading.Lock()
+_refreshing = threading.Event()
+
+# Every state that is still referenced, by the pipeline or by an open session. Their thumbnails are kept.
+_live_states = weakref.WeakSet()
+
+
+# Fetch the image paths using glob, together with their size and modification time to detect changes
+def _scan():
+    paths = sorted(glob.glob(os.path.join(APP_DIR, "static", "*.jpg")))
+    signature = tuple((f, os.path.getsize(f), os.path.getmtime(f)) for f in paths)
+    return paths, signature
+
+
+def _url(f):
+    return ROOT + os.path.relpath(f, APP_DIR).replace(os.sep, "/")
+
+
+# One process pool is used for all batches of a run, for the histograms as well as the thumbnails
+def _run(state, paths):
+    with worker_pool() as pool:
+        _run_batches(state, paths, pool)
+
+
+def _run_batches(state, paths, pool):
+    projection = ProgressivePCA()
+    H_color_arr = np.empty(shape=(state.N, N_BINS_COLOR**3), dtype=np.float32)
+    order = []
+
+    # publish a batch of loaded images with their thumbnails and a preliminary PCA projection
+    def on_batch(indices, H_color, H_channel):
+        start, stop = state.n_loaded, state.n_loaded + len(indices)
+        thumbs = make_thumbnails([paths[idx] for idx in indices], pool=pool)
+        state.thumbnails.extend(thumbs)
+        state.image[start:stop] = [_url(thumb) for thumb in thumbs]
+        H_color_arr[start:stop] = H_color
+        state._H_channel_arr[start:stop] = H_channel
+        state._pca[start:stop] = projection.project(H_color)
+        order.extend(indices)
+        state.n_loaded = stop
+
+    try:
+        # Load the color and channel histograms from the feature store, only new or modified images are computed in
+        # a process pool, see features.py
+        load_features(paths, on_batch=on_batch, batch_size=BATCH_SIZE, pool=pool)
+
+        # Calculate the indicated dimensionality reductions. The embeddings are stored next to the feature store and
+        # only recomputed or extended for the images that changed, see embedding.py
+        tsne_im, pca_im = compute_embeddings([paths[idx] for idx in order], H_color_arr)
+        state._tsne[:] = tsne_im
+        state._pca[:] = pca_im
+        state.done = True
+    except Exception as e:
+        state.error = e
+        raise
+
+
+# the shared state of the pipeline. On the first call the pipeline is started in a background thread, the state is
+# returned right away and fills up while the images are processed
+def get_state():
+    global _state
+    with _lock:
+        if _state is None:
+            paths, signature = _scan()
+            _state = PipelineState(paths, signature)
+            _live_states.add(_state)
+            threading.Thread(target=_run, args=(_state, paths), daemon=True).start()
+        return _state
+
+
+# remove the thumbnails that no state refers to any more, only called while no pipeline run creates thumbnails
+def _remove_unused_thumbnails():
+    remove_stale_thumbnails(set(thumb for state in list(_live_states) for thumb in state.thumbnails))
+
+
+def _refresh():
+    global _state
+    try:
+        paths, signature = _scan()
+        current = get_state()
+        if signature != current.signature or current.error is not None:
+            state = PipelineState(paths, signature)
+            _live_states.add(state)
+            _run(state, paths)
+            with _lock:
+                _state = state
+    finally:
+        _remove_unused_thumbnails()
+        _refreshing.clear()
+
+
+# run the pipeline again in a background thread if the static folder changed, or if the last run failed. The new
+# state replaces the old one once it is complete: sessions that are already open keep their data and thumbnails, new
+# sessions get the new result. The thumbnails of states that are no longer shown are removed.
+def refresh_in_background():
+    state = get_state()
+    if _refreshing.is_set() or not (state.done or state.error is not None):
+        return
+    _refreshing.set()
+    threading.Thread(target=_refresh, daemon=True).start()
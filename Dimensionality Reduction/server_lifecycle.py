@@ -0,0 +1,39 @@
+import os
+import sys
+
+from tornado.ioloop import PeriodicCallback
+
+# Folder of the app and the top of the repository with atomic_files.py, which the modules of the app import
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(APP_DIR)
+
+sys.path.insert(0, REPO_DIR)
+import pipeline
+
+# Lifecycle hooks of the Bokeh directory app, see
+# https://docs.bokeh.org/en/latest/docs/user_guide/server.html#lifecycle-hooks
+
+# Periodic check of the static folder, it runs on the event loop of the server
+refresh_callback = None
+
+
+# compute the features and embeddings once when the server starts, before the first session is opened
+def on_server_loaded(server_context):
+    global refresh_callback
+    # Bokeh only puts APP_DIR on sys.path while it runs the app code, but the worker processes of the pipeline import
+    # the app modules with the sys.path of the server at the time they start, so both folders stay on it
+    for directory in (APP_DIR, REPO_DIR):
+        if directory not in sys.path:
+            sys.path.append(directory)
+    pipeline.get_state()
+
+    # Optionally check the static folder for changed images and recompute in the background. The server context has
+    # no periodic callbacks of its own, so the check is scheduled on the event loop the hook is called from
+    if pipeline.REFRESH_INTERVAL is not None:
+        refresh_callback = PeriodicCallback(pipeline.refresh_in_background, pipeline.REFRESH_INTERVAL * 1000)
+        refresh_callback.start()
+
+
+def on_server_unloaded(server_context):
+    if refresh_callback is not None:
+        refresh_callback.stop()
@@ -0,0 +1,61 @@
+import glob
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+# features.py imports atomic_files.py from the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from features import N_BINS_COLOR, N_BINS_CHANNEL, pixel_histograms
+
+# pixel_histograms has to give the same counts as np.histogramdd and np.histogram, run with
+# python -m pytest test_features.py
+
+
+def reference_histograms(np_im):
+    H_color, _ = np.histogramdd(np_im, bins=N_BINS_COLOR, range=((0, 255),) * 3)
+    H_channel = np.array([np.histogram(np_im[:, channel], bins=N_BINS_CHANNEL, range=(0, 255))[0]
+                          for channel in range(3)])
+    return H_color.flatten(), H_channel
+
+
+def assert_same_histograms(np_im):
+    H_color, H_channel = pixel_histograms(np_im)
+    H_color_ref, H_channel_ref = reference_histograms(np_im)
+    np.testing.assert_array_equal(H_color, H_color_ref)
+    np.testing.assert_array_equal(H_channel, H_channel_ref)
+
+
+def test_random_pixels():
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        np_im = rng.integers(0, 256, size=(int(rng.integers(1, 5000)), 3), dtype=np.uint8)
+        assert_same_histograms(np_im)
+
+
+def test_every_value():
+    values = np.arange(256, dtype=np.uint8)
+    for shift in range(3):
+        assert_same_histograms(np.stack([np.roll(values, shift * channel) for channel in range(3)], axis=1))
+
+
+def test_bin_edges():
+    # 0, 255 and the values at and next to every bin edge of both histograms
+    edges = np.concatenate((np.linspace(0, 255, N_BINS_COLOR + 1), np.linspace(0, 255, N_BINS_CHANNEL + 1)))
+    values = np.unique(np.clip(np.concatenate((np.floor(edges), np.ceil(edges), np.floor(edges) - 1,
+                                               np.ceil(edges) + 1)), 0, 255)).astype(np.uint8)
+    # every edge value in every channel, combined with edge values of the other channels
+    rng = np.random.default_rng(0)
+    np_im = np.stack([np.tile(values, 8) if channel == 0 else rng.permutation(np.tile(values, 8))
+                      for channel in range(3)], axis=1)
+    assert_same_histograms(np_im)
+
+
+def test_bundled_images():
+    paths = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "*.jpg")))[:5]
+    if not paths:
+        pytest.skip("no images in the static folder")
+    for f in paths:
+        assert_same_histograms(np.asarray(Image.open(f).convert('RGB'), dtype=np.uint8).reshape(-1, 3))
@@ -0,0 +1,63 @@
+import os
+
+from PIL import Image
+
+from atomic_files import replace_atomically
+from features import CHUNK_SIZE, worker_pool
+
+# Downscaled copies of the images for the image_url glyphs, which are only drawn at a tenth of the image size. The
+# thumbnails are cached on disk and the browser downloads them instead of the full size images. The name of a
+# thumbnail contains the modification time of its image, so a modified image gets a new thumbnail and sessions that
+# still show the old one can keep loading it.
+
+# The thumbnails have to be inside the static folder to be served, the glob in main.py does not descend into it
+THUMBNAIL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "thumbnails")
+
+# Size of the thumbnails relative to the images, twice the glyph size so they stay sharp on high dpi screens
+THUMBNAIL_SCALE = 0.2
+
+# JPEG quality of the thumbnails
+THUMBNAIL_QUALITY = 85
+
+
+def thumbnail_path(f):
+    stem, ext = os.path.splitext(os.path.basename(f))
+    return os.path.join(THUMBNAIL_DIR, "{}.{}{}".format(stem, os.stat(f).st_mtime_ns, ext))
+
+
+def _is_stale(f):
+    return not os.path.exists(thumbnail_path(f))
+
+
+def _make_thumbnail(f):
+    im = Image.open(f)
+    im.thumbnail((max(1, round(im.width * THUMBNAIL_SCALE)), max(1, round(im.height * THUMBNAIL_SCALE))))
+    # write to a temporary file first, so the server never serves a half written thumbnail
+    with replace_atomically(thumbnail_path(f)) as tmp_file:
+        im.convert('RGB').save(tmp_file, format="JPEG", quality=THUMBNAIL_QUALITY)
+
+
+# create the missing or stale thumbnails of the given images in pool, a process pool from worker_pool, or in a pool
+# of max_workers processes that is started for this call. Returns the thumbnail paths in the order of paths
+def make_thumbnails(paths, max_workers=None, pool=None):
+    os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+
+    stale = [f for f in paths if _is_stale(f)]
+    if len(stale) <= CHUNK_SIZE or max_workers == 1:
+        for f in stale:
+            _make_thumbnail(f)
+    elif pool is None:
+        with worker_pool(max_workers) as own_pool:
+            list(own_pool.map(_make_thumbnail, stale, chunksize=CHUNK_SIZE))
+    else:
+        list(pool.map(_make_thumbnail, stale, chunksize=CHUNK_SIZE))
+
+    return [thumbnail_path(f) for f in paths]
+
+
+# remove all thumbnails except the ones in keep, a set of thumbnail paths that are still shown
+def remove_stale_thumbnails(keep):
+    keep = set(os.path.basename(thumb) for thumb in keep)
+    for name in os.listdir(THUMBNAIL_DIR):
+        if name not in keep and not name.endswith(".tmp"):
+            os.remove(os.path.join(THUMBNAIL_DIR, name))
@@ -0,0 +1,68 @@
+import argparse
+import io
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+
+# ==========================================================================
+# Live feed: the rows that were appended to a CSV file since the last read
+# Only the new bytes are read and parsed. A partially written last line is
+# left for the next read. If the file got shorter, it was rewritten and is
+# read again from the start, the caller drops the rows it already has.
+# ==========================================================================
+
+
+# parse is called with the header and the new rows as bytes, offset is the first byte to read, by default the start
+# of the first row
+class CsvTail:
+    def __init__(self, path, offset=None, parse=None):
+        self.path = path
+        self.parse = parse if parse is not None else (lambda data: pd.read_csv(io.BytesIO(data)))
+        with open(path, 'rb') as f:
+            self.header = f.readline()
+        self.offset = len(self.header) if offset is None else offset
+
+    # the complete rows appended since the last call as a DataFrame, None if there are none. The first call returns
+    # all rows of the file
+    def read(self):
+        size = os.path.getsize(self.path)
+        if size < self.offset:
+            self.offset = len(self.header)
+        if size == self.offset:
+            return None
+
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            chunk = f.read(size - self.offset)
+        end = chunk.rfind(b'\n') + 1
+        if end == 0:
+            return None
+        self.offset += end
+        return self.parse(self.header + chunk[:end])
+
+
+# Stand-in for a live data source: append a made up row for the next day to a copy of the data set every few seconds,
+# then run the dashboard on the copy with "bokeh serve main.py --args <copy>"
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Append simulated daily test statistics to a CSV file.")
+    parser.add_argument('path', help="copy of covid19_tests_switzerland_bag.csv to append to")
+    parser.add_argument('--interval', type=float, default=2.0, help="seconds between two rows")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    last = pd.read_csv(args.path).iloc[-1]
+    index, day = int(last.iloc[0]), pd.Timestamp(last.date)
+    n_tests, frac_positive = float(last.n_tests), float(last.frac_positive)
+    while True:
+        time.sleep(args.interval)
+        index, day = index + 1, day + pd.Timedelta(days=1)
+        n_tests = max(1.0, n_tests * rng.lognormal(0, 0.1))
+        frac_positive = float(np.clip(frac_positive + rng.normal(0, 0.01), 0, 1))
+        n_positive = int(round(n_tests * frac_positive))
+        with open(args.path, 'a') as f:
+            f.write(f"{index},{day:%Y-%m-%d},{int(n_tests) - n_positive},{n_positive},{int(n_tests)},"
+                    f"{n_positive / int(n_tests)}\n")
@@ -0,0 +1,94 @@
+import numbers
+
+import numpy as np
+import pandas as pd
+
+
+# ==========================================================================
+# Level of detail for long time series
+# The overview line only needs the shape of the series, so it draws a series
+# reduced with Largest-Triangle-Three-Buckets (LTTB). The detail scatter plot
+# picks its points from a min-max pyramid: the finest level that fits into the
+# point budget inside the visible x_range, so spikes survive at every zoom level.
+# All functions return sorted row indices, the rows have to be sorted by x.
+# ==========================================================================
+
+
+## Downsampling
+
+# Largest-Triangle-Three-Buckets: keep the first and last point and from every one of the n_out - 2 buckets in
+# between the point that spans the largest triangle with the previously kept point and the mean of the next bucket
+# reference: https://skemman.is/handle/1946/15343 (S. Steinarsson, Downsampling Time Series for Visual Representation)
+def lttb(x, y, n_out):
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.nan_to_num(np.asarray(y, dtype=np.float64))
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for bucket in range(n_out - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        if bucket + 2 < len(edges):
+            next_bucket = slice(stop, edges[bucket + 2])
+        else:
+            next_bucket = slice(n - 1, n)
+        avg_x, avg_y = x[next_bucket].mean(), y[next_bucket].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:stop] - y[a]) - (x[a] - x[start:stop]) * (avg_y - y[a]))
+        a = start + np.argmax(area)
+        indices[bucket + 1] = a
+    return indices
+
+
+# keep the minimum and the maximum of each of n_out / 2 buckets of consecutive points
+def minmax(y, n_out):
+    n = len(y)
+    n_buckets = n_out // 2
+    if n_buckets < 1 or 2 * n_buckets >= n:
+        return np.arange(n)
+    y = np.nan_to_num(np.asarray(y, dtype=np.float64))
+
+    edges = np.linspace(0, n, n_buckets + 1).astype(np.int64)
+    bucket = np.repeat(np.arange(n_buckets), np.diff(edges))
+    # sorted by bucket and then by value, so the first point of a bucket is its minimum and the last its maximum
+    order = np.lexsort((y, bucket))
+    return np.unique(np.concatenate((order[edges[:-1]], order[edges[1:] - 1])))
+
+
+## Pyramid
+
+# convert a range bound to milliseconds since epoch, the unit of datetime axes in BokehJS. The browser sends numbers,
+# the initial range may be given as datetimes
+def to_ms(value):
+    if isinstance(value, numbers.Number):
+        return float(value)
+    return pd.Timestamp(value).value / 1e6
+
+
+# Min-max pyramid of a series: level 0 holds all points and every further level about a factor fewer, until a level
+# has at most min_points points
+class LevelOfDetail:
+    def __init__(self, x, y, factor=4, min_points=1000):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.levels = [np.arange(len(self.x))]
+        y = np.asarray(y)
+        while len(self.levels[-1]) > min_points:
+            level = self.levels[-1]
+            coarser = level[minmax(y[level], len(level) // factor)]
+            if len(coarser) == len(level):
+                break
+            self.levels.append(coarser)
+
+    # indices of the points between start and end, both included, from the finest level with at most max_points of
+    # them there. One more point on each side is included, so points at the edges do not pop in and out while panning
+    def window(self, start, end, max_points):
+        for level in self.levels:
+            x = self.x[level]
+            lo = max(np.searchsorted(x, start, side='left') - 1, 0)
+            hi = min(np.searchsorted(x, end, side='right') + 1, len(level))
+            if hi - lo <= max_points:
+                return level[lo:hi]
+        return level[lo:hi]
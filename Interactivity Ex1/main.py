@@ -1,12 +1,25 @@
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd 
 import numpy as np
 import bokeh.palettes as bp
 from bokeh.plotting import figure
-from bokeh.io import output_file, show, save
+from bokeh.io import output_file, show, save, curdoc
+from bokeh.resources import CDN
 from bokeh.models import ColumnDataSource, HoverTool, ColorBar, RangeTool
 from bokeh.transform import linear_cmap
 from bokeh.layouts import gridplot
 
+# The CSV files are read through the ingest layer at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import covid_ingest
+
+from feed import CsvTail
+from lod import LevelOfDetail, lttb, to_ms
+
 
 # ==========================================================================
 # Goal: Visualize Covid-19 Tests statistics in Switzerland with linked plots
@@ -18,6 +31,24 @@ from bokeh.layouts import gridplot
 # 		frac_negative: fraction of POSITIVE cases in tests
 # ==========================================================================
 
+# Run as a script to render the static main.html, or with "bokeh serve main.py",
+# which only sends the points inside the visible date range to the browser.
+# "python main.py --group-by month" or "--group-by metric" renders a batch of
+# reports in a process pool instead, see T2.7
+SERVER_MODE = __name__.startswith('bokeh_app')
+
+# Number of points of the overview line
+MAX_OVERVIEW_POINTS = 2000
+# Number of points the scatter plot draws at most in server mode
+MAX_DETAIL_POINTS = 5000
+
+# In server mode, milliseconds between two checks of the CSV file for appended rows, None disables the live mode.
+# "bokeh serve main.py --args <csv>" watches another file, for example one fed by feed.py
+LIVE_INTERVAL = 5000
+# Number of most recent rows kept in server mode
+ROLLOVER = 1000000
+CSV_FILE = sys.argv[1] if SERVER_MODE and len(sys.argv) > 1 else "covid19_tests_switzerland_bag.csv"
+
 
 
 ### Task1: Data Preprocessing
@@ -27,24 +58,54 @@ from bokeh.layouts import gridplot
 # You can read the latest data from the url, or use the data provided in the folder (update Nov.3, 2020)
 
 # url = 'https://github.com/daenuprobst/covid19-cases-switzerland/blob/master/covid19_tests_switzerland_bag.csv'
-raw = pd.read_csv("covid19_tests_switzerland_bag.csv")
+# Explicit dtypes of the data set, see covid_ingest.py
+CSV_OPTIONS = dict(dtype={'n_negative': np.int64, 'n_positive': np.int64, 'n_tests': np.int64,
+                          'frac_positive': np.float64},
+                   dates=['date'], index_col=0)
+raw = covid_ingest.load(CSV_FILE, complete_lines=SERVER_MODE and LIVE_INTERVAL is not None, **CSV_OPTIONS)
+
+# In the live mode, a CsvTail continues reading where the ingest stopped, see feed.py
+feed = CsvTail(CSV_FILE, offset=raw.attrs['n_bytes'], parse=lambda data: covid_ingest.parse(data, **CSV_OPTIONS))
 
 
 
 ## T1.2 Create a ColumnDataSource containing: date, positive number, positive rate, total tests
 # All the data can be extracted from the raw dataframe.
 
-date = pd.to_datetime(raw.date.tolist())
-pos_num = raw.n_positive.tolist()
-pos_rate = raw.frac_positive.tolist()
-test_num = raw.n_tests.tolist()
+# The columns are NumPy arrays, which Bokeh sends to the browser in its binary array encoding
+def columns(df):
+    return {'date':df.date.values,
+            'pos_num':df.n_positive.values,
+            'pos_rate':df.frac_positive.values,
+            'test_num':df.n_tests.values,
+            'neg_num':df.n_negative.values}
+
 
-source_dict = {'date':date,
-               'pos_num':pos_num,
-               'pos_rate':pos_rate,
-               'test_num':test_num}
+source_dict = columns(raw)
+date = pd.to_datetime(source_dict['date'])
+pos_num = source_dict['pos_num']
+pos_rate = source_dict['pos_rate']
+test_num = source_dict['test_num']
 
-source = ColumnDataSource(data=source_dict)
+
+# the rows with the given indices, as column data
+def take(indices):
+    return {key: values[indices] for key, values in source_dict.items()}
+
+
+## T1.4 Level of detail
+# The overview line draws an LTTB reduced series. In server mode, the scatter plot only gets the points inside its
+# x_range, picked from a min-max pyramid whenever the range changes, see lod.py. The static main.html keeps all points.
+
+x_ms = date.values.astype('datetime64[ms]').astype(np.float64)
+overview_source = ColumnDataSource(data=take(lttb(x_ms, pos_num, MAX_OVERVIEW_POINTS)))
+
+if SERVER_MODE:
+    detail = LevelOfDetail(x_ms, test_num)
+    shown = detail.window(x_ms[0], x_ms[min(29, len(x_ms) - 1)], MAX_DETAIL_POINTS)
+    source = ColumnDataSource(data=take(shown))
+else:
+    source = ColumnDataSource(data=source_dict)
 
 
 ## T1.3 Map the range of positive rate to a colormap using module "linear_cmap"
@@ -52,7 +113,6 @@ source = ColumnDataSource(data=source_dict)
 
 low = min(pos_rate)
 high = max(pos_rate)
-mapper = linear_cmap('pos_rate',bp.Inferno256,low,high)
 
 
 
@@ -60,71 +120,197 @@ mapper = linear_cmap('pos_rate',bp.Inferno256,low,high)
 ### Task2: Data Visualization
 # Reference link:
 # (range tool example) https://docs.bokeh.org/en/latest/docs/gallery/range_tool.html?highlight=rangetool
+# The plots are built by make_plots, which the batch mode at the end of this file uses for every report as well
+
+# Metrics the scatter plot can show, with their axis label
+METRICS = {'test_num': "Total Tests",
+           'pos_num': "Positive Cases",
+           'neg_num': "Negative Cases"}
+
+
+def make_plots(source, overview_source, x_range, low, high, metric='test_num', title='Covid-19 Tests in Switzerland'):
+    mapper = linear_cmap('pos_rate',bp.Inferno256,low,high)
+
+
+    ## T2.1 Covid-19 Total Tests Scatter Plot
+    # x axis is the time, and y axis is the total test number. 
+    # Set the initial x_range to be the first 30 days.
+
+    TOOLS = "box_select,lasso_select,wheel_zoom,pan,reset,help"
+    p = figure(x_axis_type="datetime",x_range = x_range,plot_height=600,tools=TOOLS)
+    p.scatter('date',metric,size=10,color=mapper,line_width=1,line_color="blue",source = source)
+
+    p.title.text = title
+    p.yaxis.axis_label = METRICS[metric]
+    p.xaxis.axis_label = "Date"
+    p.sizing_mode = "stretch_both"
+
+    # Add a hovertool to display date, total test number
+    hover = HoverTool(tooltips=[("Date", "@date{%F}"),
+                                (METRICS[metric],'@' + metric)
+                                ],
+                      formatters={'@date': 'datetime'})
+    p.add_tools(hover)
+
+
+    ## T2.2 Add a colorbar to the above scatter plot; please use the color mapper defined in T1.3
+
+    color_bar = ColorBar(color_mapper=mapper["transform"],title="P_Rate",location=(0,0))
+    p.add_layout(color_bar, 'right')
+
+
+
+
+    ## T2.3 Covid-19 Positive Number Plot using RangeTool
+    # In this range plot, x axis is the time, and y axis is the positive test number.
+
+    select = figure(title="Drag the middle and edges of the selection box to change the range above",
+                    x_axis_type="datetime",plot_height=250,tools="", toolbar_location=None)
 
+    # Define a RangeTool to link with x_range in the scatter plot
+    range_tool = RangeTool(x_range=p.x_range)
+    range_tool.overlay.fill_color = "green"
+    range_tool.overlay.fill_alpha = 0.2
 
-## T2.1 Covid-19 Total Tests Scatter Plot
-# x axis is the time, and y axis is the total test number. 
-# Set the initial x_range to be the first 30 days.
 
-TOOLS = "box_select,lasso_select,wheel_zoom,pan,reset,help"
-p = figure(x_axis_type="datetime",x_range = (date[0],date[29]),plot_height=600,tools=TOOLS)
-p.scatter('date','test_num',size=10,color=mapper,line_width=1,line_color="blue",source = source)
+    # Draw a line plot and add the RangeTool to the plot
+    select.line('date', 'pos_num', source=overview_source)
+    select.yaxis.axis_label = "Positive Cases"
+    select.xaxis.axis_label = "Date"
+    select.ygrid.grid_line_color = None
+    select.add_tools(range_tool)
+    select.toolbar.active_multi = range_tool
 
-p.title.text = 'Covid-19 Tests in Switzerland'
-p.yaxis.axis_label = "Total Tests"
-p.xaxis.axis_label = "Date"
-p.sizing_mode = "stretch_both"
 
-# Add a hovertool to display date, total test number
-hover = HoverTool(tooltips=[("Date", "@date{%F}"),
-							('Total tests','@test_num')
-                            ],
-                  formatters={'@date': 'datetime'})
-p.add_tools(hover)
 
+    # Add a hovertool to the range plot and display date, positive test number
+    hover2 = HoverTool(tooltips=[("Date", "@date{%F}"),
+                                 ('Positive tests','@pos_num')
+                                 ],
+                       formatters={'@date': 'datetime'})
+    select.add_tools(hover2)
 
-## T2.2 Add a colorbar to the above scatter plot; please use the color mapper defined in T1.3
+    return p, select, mapper
 
-color_bar = ColorBar(color_mapper=mapper["transform"],title="P_Rate",location=(0,0))
-p.add_layout(color_bar, 'right')
 
+p, select, mapper = make_plots(source, overview_source, (date[0], date[min(29, len(date) - 1)]), low, high)
 
 
+## T2.4 Level of detail for the scatter plot
+# In server mode, replace the points of the scatter plot when the visible range changes
+def update_detail(attr, old, new):
+    global shown
+    if following_live_edge:
+        return
+    indices = detail.window(to_ms(p.x_range.start), to_ms(p.x_range.end), MAX_DETAIL_POINTS)
+    if not np.array_equal(indices, shown):
+        shown = indices
+        source.data = take(shown)
 
-## T2.3 Covid-19 Positive Number Plot using RangeTool
-# In this range plot, x axis is the time, and y axis is the positive test number.
 
-select = figure(title="Drag the middle and edges of the selection box to change the range above",
-                x_axis_type="datetime",plot_height=250,tools="", toolbar_location=None)
+## T2.5 Live append mode
+# In server mode, the rows appended to the CSV file are read periodically. They are streamed into the scatter plot
+# while it shows the latest data, and then the window of the RangeTool moves along with the data. The overview line
+# is reduced again and the color mapper is widened by the new positive rates.
 
-# Define a RangeTool to link with x_range in the scatter plot
-range_tool = RangeTool(x_range=p.x_range)
-range_tool.overlay.fill_color = "green"
-range_tool.overlay.fill_alpha = 0.2
+following_live_edge = False
 
 
-# Draw a line plot and add the RangeTool to the plot
-select.line('date', 'pos_num', source=source)
-select.yaxis.axis_label = "Positive Cases"
-select.xaxis.axis_label = "Date"
-select.ygrid.grid_line_color = None
-select.add_tools(range_tool)
-select.toolbar.active_multi = range_tool
+def append_rows():
+    global source_dict, x_ms, detail, shown, following_live_edge
+    rows = feed.read()
+    if rows is None:
+        return
+    new = columns(rows)
+    new_ms = new['date'].astype('datetime64[ms]').astype(np.float64)
+    # a rewritten file is read again from the start, drop the rows that are already there
+    is_new = new_ms > x_ms[-1]
+    if not np.any(is_new):
+        return
+    new = {key: values[is_new] for key, values in new.items()}
+    new_ms = new_ms[is_new]
 
+    following = to_ms(p.x_range.end) >= x_ms[-1]
+    shift = new_ms[-1] - x_ms[-1]
+    trimmed = max(0, len(x_ms) + len(new_ms) - ROLLOVER)
+    source_dict = {key: np.concatenate((values, new[key]))[trimmed:] for key, values in source_dict.items()}
+    x_ms = np.concatenate((x_ms, new_ms))[trimmed:]
+    detail = LevelOfDetail(x_ms, source_dict['test_num'])
+    overview_source.data = take(lttb(x_ms, source_dict['pos_num'], MAX_OVERVIEW_POINTS))
 
+    color_mapper = mapper["transform"]
+    color_mapper.low = min(color_mapper.low, float(np.nanmin(new['pos_rate'])))
+    color_mapper.high = max(color_mapper.high, float(np.nanmax(new['pos_rate'])))
 
-# Add a hovertool to the range plot and display date, positive test number
-hover2 = HoverTool(tooltips=[("Date", "@date{%F}"),
-							('Positive tests','@pos_num')
-                            ],
-                  formatters={'@date': 'datetime'})
-select.add_tools(hover2)
+    shown = shown[shown >= trimmed] - trimmed
+    if following:
+        appended = np.arange(len(x_ms) - len(new_ms), len(x_ms))
+        shown = np.concatenate((shown, appended))[-MAX_DETAIL_POINTS:]
+        source.stream(take(appended), rollover=MAX_DETAIL_POINTS)
+        # moving the range must not replace the streamed points
+        following_live_edge = True
+        p.x_range.start = to_ms(p.x_range.start) + shift
+        p.x_range.end = to_ms(p.x_range.end) + shift
+        following_live_edge = False
 
 
-## T2.4 Layout arrangement and display
+## T2.6 Layout arrangement and display
 
 linked_p = gridplot([p,select],ncols=1,sizing_mode='stretch_width')
-show(linked_p)
-output_file("main.html")
-save(linked_p)
+if SERVER_MODE:
+    p.x_range.on_change('start', update_detail)
+    p.x_range.on_change('end', update_detail)
+    curdoc().add_root(linked_p)
+    if LIVE_INTERVAL is not None:
+        curdoc().add_periodic_callback(append_rows, LIVE_INTERVAL)
+
+
+## T2.7 Batch mode
+# Renders one report per month or per metric from the same make_plots. The reports are rendered in a process pool and
+# load BokehJS from the CDN, so every HTML file only holds its data.
+
+# render a static report of the given rows to path
+def render_report(path, title, data, metric):
+    data_ms = data['date'].astype('datetime64[ms]').astype(np.float64)
+    overview = {key: values[lttb(data_ms, data['pos_num'], MAX_OVERVIEW_POINTS)] for key, values in data.items()}
+    report_p, report_select, _ = make_plots(ColumnDataSource(data=data), ColumnDataSource(data=overview),
+                                            (pd.Timestamp(data['date'][0]), pd.Timestamp(data['date'][-1])),
+                                            np.nanmin(data['pos_rate']), np.nanmax(data['pos_rate']), metric, title)
+    save(gridplot([report_p, report_select], ncols=1, sizing_mode='stretch_width'),
+         filename=path, resources=CDN, title=title)
+    return path
+
+
+# the reports of a batch as arguments of render_report
+def batch_reports(group_by, out_dir):
+    if group_by == 'metric':
+        return [(os.path.join(out_dir, f"{metric}.html"), f"Covid-19 {label} in Switzerland", source_dict, metric)
+                for metric, label in METRICS.items()]
+
+    months = date.to_period('M')
+    reports = []
+    for month in months.unique():
+        rows = np.flatnonzero(months == month)
+        reports.append((os.path.join(out_dir, f"{month}.html"), f"Covid-19 Tests in Switzerland, {month}",
+                        take(rows), 'test_num'))
+    return reports
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Render the Covid-19 test statistics of Switzerland.")
+    parser.add_argument('--group-by', choices=['month', 'metric'],
+                        help="render one report per month or per metric instead of main.html")
+    parser.add_argument('--out-dir', default='reports', help="directory of the batch reports")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes")
+    args = parser.parse_args()
+
+    if args.group_by is None:
+        show(linked_p)
+        output_file("main.html")
+        save(linked_p)
+    else:
+        os.makedirs(args.out_dir, exist_ok=True)
+        with ProcessPoolExecutor(args.workers) as pool:
+            for path in pool.map(render_report, *zip(*batch_reports(args.group_by, args.out_dir))):
+                print(path)
 
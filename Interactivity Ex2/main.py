@@ -1,14 +1,25 @@
+import os
+import sys
 import numpy as np
 import pandas as pd
 import geopandas as gpd
 from datetime import datetime,timedelta
 
+# The CSV files are read through the ingest layer and the map levels are cached through atomic_files.py, both at the top
+# of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import covid_ingest
+
+import simplify
+
 import bokeh.palettes as bp
 from bokeh.plotting import figure,curdoc
 from bokeh.transform import linear_cmap
 from bokeh.layouts import column, row
 from bokeh.models import (CDSView, 
 						HoverTool,ColorBar,
+						ColumnDataSource,
+						CustomJS,
 						GeoJSONDataSource, 
 						Patches,
 						RadioButtonGroup,
@@ -34,6 +45,12 @@ from bokeh.models import (CDSView,
 
 # ====================================================================
 
+# If True, the slider and the Play button are handled in the browser by CustomJS callbacks, with the daily new cases
+# of all dates sent once. If False, every slider change and animation frame goes through the Python callbacks.
+CLIENT_PLAYBACK = True
+# Milliseconds between two frames of the animation
+PLAYBACK_INTERVAL = 500
+
 
 
 ### Task 1: Data Preprocessing
@@ -45,6 +62,7 @@ from bokeh.models import (CDSView,
 # covid19_cases_switzerland_openzh-phase2.csv: daily new cases in each canton
 # gadm36_CHE_1.shp: the shape file contains geometry data of swiss cantons, and is provided in the "data" folder. 
 # Please do not submit any data file with your solution, and you can asssume your solution is at the same directory as data 
+# The CSV files are parsed with explicit dtypes and cached as Parquet files until they change, see covid_ingest.py
 
 
 demo_url = 'https://github.com/daenuprobst/covid19-cases-switzerland/blob/master/demographics.csv'
@@ -55,26 +73,28 @@ shape_dir = 'data/gadm36_CHE_1.shp'
 
 # Read from demo_url into a dataframe using pandas
 raw_demo_url = demo_url+'?raw=true'
-demo_raw = pd.read_csv(raw_demo_url,index_col=0)
+demo_raw = covid_ingest.load(raw_demo_url, index_col=0, dtype={'Density': np.float64, 'BedsPerCapita': np.float64})
 
 
 # Read from local_url into a dataframe using pandas
 raw_local_url = local_url+'?raw=true'
-local_raw = pd.read_csv(raw_local_url,index_col=0)
+local_raw = covid_ingest.load(raw_local_url, index_col=0,
+							  dtype={'abbreviation_canton': str, 'lat': np.float64, 'long': np.float64})
 # Extract unique 'abbreviation_canton','lat','long' combinations from local_raw
 canton_point = local_raw[['abbreviation_canton','lat','long']].drop_duplicates()
 
 
 # Read from case_url into a dataframe using pandas
 raw_case_url = case_url+'?raw=true'
-case_raw = pd.read_csv(raw_case_url,index_col=0)
-# Create a date list from case_raw and convert to datatime form
-dates = pd.to_datetime(case_raw.index.values).tolist()
-dates_raw = case_raw.index.values.tolist()
+case_raw = covid_ingest.load(raw_case_url, index_col=0, default_dtype=np.float64, date_index=True)
+# Create a date list from case_raw, the index is already parsed to datetime form
+dates = case_raw.index.tolist()
+dates_raw = case_raw.index.strftime(covid_ingest.DATE_FORMAT).tolist()
 
 
-# Read shape file from shape_dir using geopandas
-shape_raw = gpd.read_file(shape_dir)
+# Read shape file from shape_dir using geopandas, together with its simplified levels, see simplify.py
+shape_levels = simplify.load_levels(shape_dir)
+shape_raw = shape_levels[-1]
 # Extract canton name abbreviations from the attribute 'HASC_1', e.g. CH.AG --> AG, CH.ZH --> ZH
 # And save into a new column named 'Canton' 
 shape_raw['Canton'] = shape_raw.HASC_1.str.split('.').str[1]
@@ -84,7 +104,7 @@ canton_poly = shape_raw[['geometry','Canton']]
 
 
 
-## T1.2 Merge data and build a GeoJSONDataSource
+## T1.2 Merge data and build a GeoJSONDataSource for the polygons and a ColumnDataSource for the circles
 
 # Merge canton_poly with demo_raw on attribute name 'Canton' into dataframe merged,
 # then merge the result with canton_point on 'Canton' and 'abbreviation_canton' respectively
@@ -95,23 +115,37 @@ canton_poly = shape_raw[['geometry','Canton']]
 merged = canton_poly.merge(demo_raw, left_on = 'Canton', right_on = demo_raw.index)
 merged = merged.merge(canton_point, left_on = 'Canton', right_on = 'abbreviation_canton')
 
-# For each date, extract a list of daily new cases per capita from all cantons(e.g. 'AG_diff_pc', 'AI_diff_pc', etc.), and add as a new column in merged
-# For instance, in the column['2020-10-31'], there are: [0.0005411327220155498, nan, nan, 0.000496300306803826, ...]
+# The daily new cases per capita of all cantons (e.g. 'AG_diff_pc', 'AI_diff_pc', etc.) are kept in a dense float32
+# matrix dnc_arr with one row per date and one column per row of merged, matched by the canton abbreviation.
+# date_index maps a date in the form '%Y-%m-%d' to its row, so a date is looked up with a single row slice.
+# For instance, the row of '2020-10-31' is: [0.0005411327220155498, nan, nan, 0.000496300306803826, ...]
+# Cantons without a '_diff_pc' column are nan
+dnc_arr = np.ascontiguousarray(case_raw.reindex(columns=[c + '_diff_pc' for c in merged.Canton]).to_numpy(dtype=np.float32))
+date_index = {d: i for i,d in enumerate(dates_raw)}
 
-# Select only columns which contain '_diff_pc' and omit column with 'CH'
-column_index = [case_raw.columns.get_loc(c) for c in case_raw.columns if '_diff_pc' in c]
-del column_index[-1]
+# Calculate circle sizes that are proportional to dnc per capita
+def circle_size(dnc):
+	return dnc*1e5/5+10
 
-for i,d in enumerate(dates_raw):
-	merged[d] = list(case_raw.iloc[i,column_index])
+# GeoJSON of the polygons and demographics in merged, with the polygons of a level of shape_levels
+def level_geojson(shapes):
+	geometry = shapes.set_index(shapes.HASC_1.str.split('.').str[1]).geometry
+	return gpd.GeoDataFrame(merged[['Canton','Density','BedsPerCapita']],
+							geometry = merged.Canton.map(geometry).values, crs = merged.crs).to_json()
 
-# Calculate circle sizes that are proportional to dnc per capita
-# Set the latest dnc as default 
-merged['size'] = merged.iloc[:,-1]*1e5/5+10
-merged['dnc'] = merged.iloc[:,-2]
+level_geojsons = [level_geojson(shapes) for shapes in shape_levels]
+
+# Build a GeoJSONDataSource from the polygons and demographics in merged. It is sent to the browser once, the per date
+# columns stay on the server. It starts with the coarsest level, finer levels replace it when zooming in, see T2.2
+geosource = GeoJSONDataSource(geojson = level_geojsons[0])
 
-# Build a GeoJSONDataSource from merged
-geosource = GeoJSONDataSource(geojson = merged.to_json())
+# The circles get their own data source, the slider only patches their size and dnc
+# Set the latest dnc as default 
+circle_source = ColumnDataSource(data = dict(Canton = merged.Canton.values,
+											 long = merged.long.values,
+											 lat = merged.lat.values,
+											 size = circle_size(dnc_arr[-1]),
+											 dnc = dnc_arr[-1]))
 
 
 
@@ -158,19 +192,43 @@ color_bar = ColorBar(color_mapper=mappers['Density']['transform'], width=20, tit
 p1.add_layout(color_bar, 'right')
 
 
-# Add a hovertool to display canton, density, bedspercapita and dnc 
+# Add a hovertool to display canton, density and bedspercapita
 hover = HoverTool(tooltips=[('Canton','@Canton'),
 							('Population Density','@Density{int}'),
-							('Beds Per Capita','@BedsPerCapita'),
-							('Daily New Cases per Capita','@dnc')],
+							('Beds Per Capita','@BedsPerCapita')],
 				  renderers=[cantons])
 
 p1.add_tools(hover)
 
 
+# Switch to the finest level of the polygons the current zoom allows
+map_bounds = merged.total_bounds
+shown_level = 0
+
+def update_level(attr, old, new):
+	global shown_level
+	if p1.x_range.start is None or p1.x_range.end is None:
+		return
+	zoom = (map_bounds[2] - map_bounds[0]) / max(p1.x_range.end - p1.x_range.start, 1e-12)
+	level = max([i for i,(min_zoom,_) in enumerate(simplify.LEVELS) if zoom >= min_zoom], default = 0)
+	if level != shown_level:
+		shown_level = level
+		geosource.geojson = level_geojsons[level]
+
+p1.x_range.on_change('start', update_level)
+p1.x_range.on_change('end', update_level)
+
+
 
 # T2.3 Add circles at the locations of capital cities for each canton, and the sizes are proportional to daily new cases per capita
-sites = p1.circle(x='long',y='lat',size="size",source = geosource, color="blue", fill_alpha = 0.4, line_width = 0.2)
+sites = p1.circle(x='long',y='lat',size="size",source = circle_source, color="blue", fill_alpha = 0.4, line_width = 0.2)
+
+# The dnc is shown by a hovertool of the circles, they carry the per date data
+hover_sites = HoverTool(tooltips=[('Canton','@Canton'),
+								  ('Daily New Cases per Capita','@dnc')],
+						renderers=[sites])
+
+p1.add_tools(hover_sites)
 
 
 # T2.4 Create a radio button group with labels 'Density', and 'BedsPerCapita'
@@ -196,8 +254,7 @@ timeslider = DateSlider(start=dates[0], end=dates[-1], value=dates[-1], step=1,
 # Complete the callback function
 # Hints:
 # 	convert the timestamp value from the slider to datetime and format it in the form of '%Y-%m-%d'
-#	update columns 'size', 'dnc' with the column named '%Y-%m-%d' in merged
-#	update geosource with new merged
+#	patch columns 'size', 'dnc' of circle_source with the row of '%Y-%m-%d' in dnc_arr
 
 def callback(attr,old,new):
 	# Convert timestamp to datetime
@@ -205,13 +262,36 @@ def callback(attr,old,new):
 	date = datetime.fromtimestamp(timeslider.value / 1e3)
 	i = date.strftime('%Y-%m-%d')
 
-	merged.size = merged.loc[:,i]*1e5/5+10
-	merged.dnc = merged.loc[:,i]
-	geosource.geojson = merged.to_json()
-
+	dnc = dnc_arr[date_index[i]]
+	rows = slice(0, len(dnc))
+	circle_source.patch({'size': [(rows, circle_size(dnc))],
+						 'dnc': [(rows, dnc)]})
+
+
+# In the client playback mode, the browser gets dnc_arr flattened as a single float32 column, and the dates as
+# timestamps, and updates the circles itself. The size is computed as in circle_size.
+series_source = ColumnDataSource(data = dict(dnc = dnc_arr.ravel()))
+days = [d.value / 1e6 for d in dates]
+
+js_callback = CustomJS(args = dict(slider = timeslider, source = circle_source, series = series_source, days = days),
+					   code = """
+	const n = source.data['dnc'].length
+	const dnc = series.data['dnc']
+	let row = 0
+	while (row + 1 < days.length && days[row + 1] <= slider.value)
+		row++
+	for (let i = 0; i < n; i++) {
+		source.data['dnc'][i] = dnc[row * n + i]
+		source.data['size'][i] = dnc[row * n + i] * 1e5 / 5 + 10
+	}
+	source.change.emit()
+""")
 
 # Circles change on mouse move
-timeslider.on_change('value', callback)
+if CLIENT_PLAYBACK:
+	timeslider.js_on_change('value', js_callback)
+else:
+	timeslider.on_change('value', callback)
 
 
 # T2.6 Add a play button to change slider value and update the map plot dynamically
@@ -233,13 +313,33 @@ def animate():
 	global callback_id
 	if button.label == '► Play':
 		button.label = '❚❚ Pause'
-		callback_id = curdoc().add_periodic_callback(animate_update_slider, 500)
+		callback_id = curdoc().add_periodic_callback(animate_update_slider, PLAYBACK_INTERVAL)
 	else:
 		button.label = '► Play'
 		curdoc().remove_periodic_callback(callback_id)
 
+# The same in the browser for the client playback mode, the timer id is kept in the tags of the button
+js_animate = CustomJS(args = dict(slider = timeslider, interval = PLAYBACK_INTERVAL), code = """
+	const button = cb_obj
+	if (button.label == '► Play') {
+		button.label = '❚❚ Pause'
+		button.tags = [setInterval(function() {
+			let value = slider.value - 86400000
+			if (value < slider.start)
+				value = slider.end
+			slider.value = value
+		}, interval)]
+	} else {
+		button.label = '► Play'
+		clearInterval(button.tags[0])
+	}
+""")
+
 button = Button(label='► Play', width=80, height=40)
-button.on_click(animate)
+if CLIENT_PLAYBACK:
+	button.js_on_click(js_animate)
+else:
+	button.on_click(animate)
 
 
 
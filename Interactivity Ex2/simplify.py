@@ -0,0 +1,76 @@
+import os
+
+import geopandas as gpd
+
+# The cache files are written through atomic_files.py at the top of the repository, see main.py
+from atomic_files import replace_atomically
+
+
+# ====================================================================
+# Multi-resolution polygons for the map
+# Every level is a simplified copy of a shape file for a range of zoom levels.
+# The geometries are simplified with preserve_topology=True, so no polygon
+# becomes invalid or disappears. The simplified copies are cached as GeoJSON
+# files and rebuilt when the shape file changes. Works for any shape file,
+# e.g. the municipalities as well as the cantons.
+# ====================================================================
+
+# Directory of the cached levels
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+
+# (minimum zoom, tolerance) of every level, from coarse to fine. The zoom is the width of the whole map divided by
+# the visible width, the tolerance is in the units of the shape file (degrees for gadm). The last level is the shape
+# file itself.
+LEVELS = ((0, 0.005),
+		  (5, 0.001),
+		  (25, None))
+
+
+# the version of a shape file: the size and modification time of the .shp file with the geometries and of the .dbf
+# file with the attributes, so a change to either of them gets new levels
+def _version(shape_file):
+	version = []
+	for f in (shape_file, os.path.splitext(shape_file)[0] + '.dbf'):
+		if os.path.exists(f):
+			st = os.stat(f)
+			version += [st.st_size, st.st_mtime_ns]
+	return '.'.join(map(str, version))
+
+
+# the cache file of a shape file simplified with tolerance, named after the version of the shape file
+def _cache_file(shape_file, tolerance):
+	name = os.path.splitext(os.path.basename(shape_file))[0]
+	return os.path.join(CACHE_DIR, f"{name}.{_version(shape_file)}.{tolerance}.geojson")
+
+
+# the shape file simplified with tolerance, from the cache if possible. shapes is the shape file if it was read already
+def simplified(shape_file, tolerance, shapes=None):
+	cache_file = _cache_file(shape_file, tolerance)
+	if os.path.exists(cache_file):
+		return gpd.read_file(cache_file)
+
+	if shapes is None:
+		shapes = gpd.read_file(shape_file)
+	result = shapes.copy()
+	result['geometry'] = shapes.geometry.simplify(tolerance, preserve_topology=True)
+
+	# drop the levels of older versions of the shape file
+	os.makedirs(CACHE_DIR, exist_ok=True)
+	name = os.path.splitext(os.path.basename(shape_file))[0]
+	current = f"{name}.{_version(shape_file)}."
+	for old_file in os.listdir(CACHE_DIR):
+		if old_file.startswith(name + ".") and old_file.endswith(".geojson") and not old_file.startswith(current):
+			os.remove(os.path.join(CACHE_DIR, old_file))
+
+	# write to a temporary file first, so an interrupted write never leaves a broken level behind
+	with replace_atomically(cache_file) as tmp_file:
+		# the GeoJSON driver does not overwrite the empty temporary file
+		os.remove(tmp_file)
+		result.to_file(tmp_file, driver='GeoJSON')
+	return result
+
+
+# all levels of a shape file in the order of levels, the rows are in the order of the shape file
+def load_levels(shape_file, levels=LEVELS):
+	shapes = gpd.read_file(shape_file)
+	return [shapes if tolerance is None else simplified(shape_file, tolerance, shapes) for _, tolerance in levels]
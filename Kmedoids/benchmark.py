@@ -0,0 +1,107 @@
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+
+from pam import pairwise_distances, default_medoids, clara, k_medoids
+
+# Headless benchmark of the k-medoids engine in pam.py, no Bokeh document is needed.
+# Every case clusters a synthetic blob dataset and records the wall time, the number of evaluated swaps, the peak
+# memory traced by tracemalloc (NumPy reports its allocations there) and the final cost. The results are written to
+# a JSON file, and a previous results file can be passed with --compare to see the change per case.
+
+# Default grid of dataset sizes, numbers of clusters and dimensions
+SIZES = [500, 1000, 2000, 4000]
+CLUSTERS = [3, 8]
+DIMENSIONS = [4, 32]
+
+
+# k gaussian blobs with unit variance around centers drawn uniformly from [-10, 10]^d
+def make_blobs(n, k, d, rng):
+    centers = rng.uniform(-10, 10, size=(k, d))
+    return centers[rng.integers(k, size=n)] + rng.normal(size=(n, d))
+
+
+# cluster one dataset with the same settings the dashboard uses for non-random medoids
+def run_case(n, k, d, metric, mode, seed):
+    rng = np.random.default_rng(seed)
+    X = make_blobs(n, k, d, rng)
+    stats = {}
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    if mode == 'PAM':
+        D = pairwise_distances(X, metric)
+        distance_time = time.perf_counter() - start
+        _, _, cost = k_medoids(D, default_medoids(n, k), stats=stats)
+        del D
+    else:
+        distance_time = 0.0
+        _, _, cost = clara(X, k, np.random.default_rng(seed), metric=metric, stats=stats)
+    wall_time = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return dict(n=n, k=k, d=d, metric=metric, mode=mode, seed=seed,
+                wall_time=wall_time,
+                distance_time=distance_time,
+                passes=stats.get('passes', 0),
+                swap_evaluations=stats.get('swap_evaluations', 0),
+                peak_memory=peak,
+                cost=float(cost))
+
+
+# print the relative change of the wall time and the cost for every case that is also in the previous results
+def compare(results, previous):
+    def case(r):
+        return r['n'], r['k'], r['d'], r['metric'], r['mode'], r['seed']
+
+    old = {case(r): r for r in previous['results']}
+    for r in results:
+        if case(r) not in old:
+            continue
+        o = old[case(r)]
+        print("n={:>6} k={:>3} d={:>3} {:>6} {:>5}: time {:8.3f}s -> {:8.3f}s ({:+6.1f}%), cost {:.4f} -> {:.4f}".format(
+            r['n'], r['k'], r['d'], r['metric'], r['mode'], o['wall_time'], r['wall_time'],
+            100 * (r['wall_time'] / o['wall_time'] - 1), o['cost'], r['cost']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the k-medoids engine on synthetic blob datasets")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--clusters', type=int, nargs='+', default=CLUSTERS)
+    parser.add_argument('--dimensions', type=int, nargs='+', default=DIMENSIONS)
+    parser.add_argument('--metric', default='L1')
+    parser.add_argument('--mode', choices=['PAM', 'CLARA'], default='PAM')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help="previous results file to compare against")
+    args = parser.parse_args()
+
+    results = []
+    for n in args.sizes:
+        for k in args.clusters:
+            for d in args.dimensions:
+                result = run_case(n, k, d, args.metric, args.mode, args.seed)
+                print("n={n:>6} k={k:>3} d={d:>3}: {wall_time:8.3f}s, {swap_evaluations:>12} swaps, "
+                      "{peak_memory:>12} bytes peak, cost {cost:.4f}".format(**result))
+                results.append(result)
+
+    with open(args.output, 'w') as f:
+        json.dump(dict(numpy=np.__version__, python=platform.python_version(), machine=platform.machine(),
+                       results=results), f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
+
+# python benchmark.py
+# python benchmark.py --sizes 10000 20000 --mode CLARA --output clara.json
+# python benchmark.py --output new.json --compare benchmark_results.json
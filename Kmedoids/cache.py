@@ -0,0 +1,103 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from pam import pairwise_distances
+
+# Process-wide caches of the distance matrices and of the clustering results (medoids, labels, cost). Like the worker
+# pool they live in an imported module, so all sessions of a Bokeh server process share them.
+
+# Directory of the distance matrices, in shared memory (/dev/shm) where available. The files are named after the hash
+# of the features and the metric, so a restarted server reuses them instead of leaving new copies behind
+DISTANCE_DIR = os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "kmedoids")
+
+# Maximum number of results kept, the least recently used result is evicted first
+MAX_ENTRIES = 64
+
+
+# hash of the feature matrix, computed once per dataset and used as part of every cache key
+def fingerprint(X):
+    X = np.ascontiguousarray(X)
+    digest = hashlib.sha1(X.tobytes())
+    digest.update(str((X.shape, X.dtype.str)).encode())
+    return digest.hexdigest()
+
+
+# LRU cache of clustering results. A key describes everything a result depends on: the hash of the feature matrix,
+# k, the metric and the initial medoids (or the seed and the number of restarts for random medoids).
+class ResultCache:
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, result):
+        medoids, labels, cost = result
+        labels = np.array(labels)
+        labels.setflags(write=False)
+        with self._lock:
+            self._entries[key] = (list(medoids), labels, cost)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+# Distance matrices keyed by the hash of the feature matrix and the metric. Every matrix is computed once, by the
+# first session that needs it, and written to a memory-mapped .npy file: a new file is written under a temporary name
+# and then renamed, an existing file is only opened read-only. The restart workers map the same file.
+class DistanceStore:
+    def __init__(self, directory=DISTANCE_DIR):
+        self.directory = directory
+        self._matrices = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, features, features_hash, metric):
+        key = (features_hash, metric)
+        with self._lock:
+            if key in self._matrices:
+                return self._matrices[key]
+            lock = self._locks.setdefault(key, threading.Lock())
+
+        # only one session computes a matrix, the others wait for it
+        with lock:
+            with self._lock:
+                if key in self._matrices:
+                    return self._matrices[key]
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, "distances_{}_{}.npy".format(features_hash, metric))
+            n = len(features)
+            try:
+                D = np.load(path, mmap_mode='r')
+                if D.shape != (n, n):
+                    raise ValueError("stale distance matrix")
+            except (OSError, ValueError):
+                fd, tmp_file = tempfile.mkstemp(dir=self.directory, suffix=".npy")
+                os.close(fd)
+                try:
+                    D = pairwise_distances(features, metric, out=tmp_file)
+                    D.flush()
+                    del D
+                    os.replace(tmp_file, path)
+                except BaseException:
+                    os.remove(tmp_file)
+                    raise
+                D = np.load(path, mmap_mode='r')
+            with self._lock:
+                self._matrices[key] = D
+            return D
+
+
+results = ResultCache()
+distances = DistanceStore(DISTANCE_DIR)
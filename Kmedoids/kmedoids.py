@@ -1,91 +1,180 @@
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
 import numpy as np
-from bokeh.models import ColumnDataSource, Button, Select, Div
+from bokeh.models import ColumnDataSource, Button, Select, Div, TextInput, LinearColorMapper
 from bokeh.sampledata.iris import flowers
 from bokeh.plotting import figure, curdoc
 from bokeh.layouts import column, row
+from bokeh.transform import transform
+from pam import default_medoids, fits_in_memory, clara, multi_restart, k_medoids as run_k_medoids
+from workers import executor, process_pool, discard_process_pool
+from cache import fingerprint, results, distances
 
 # Important: You must also install pandas for the data import.
 
-# calculate the cost of the current medoid configuration
-# The cost is the sum of all minimal distances of all points to the closest medoids
-def get_cost(meds):
-    dist_1 = np.linalg.norm(data.iloc[:, 0:4] - data.iloc[meds[0], 0:4],ord=1,axis=1)
-    dist_2 = np.linalg.norm(data.iloc[:, 0:4] - data.iloc[meds[1], 0:4],ord=1,axis=1)
-    dist_3 = np.linalg.norm(data.iloc[:, 0:4] - data.iloc[meds[2], 0:4],ord=1,axis=1)
-    return np.sum(np.amin(np.column_stack((dist_1, dist_2, dist_3)),axis = 1))
+# Colors of the clusters, the dashboard allows up to 10 clusters
+COLORS = ["red", "green", "blue", "orange", "purple", "brown", "pink", "olive", "cyan", "black"]
+
+# Distances offered in the dashboard, see pam.METRICS
+METRIC_OPTIONS = ['L1', 'L2', 'cosine']
+
+
+# the pairwise distances of a metric are only computed for the first PAM run in the server process and then shared by
+# every following run of all sessions, see cache.DistanceStore
+def get_distances(metric):
+    return distances.get(features, features_hash, metric)
+
+
+# runs in the worker pool: cluster the data and report the cost of every improving swap to the dashboard
+# Finished results are stored in the process-wide cache under the given key, unless the job was cancelled
+def run_clustering(k, medoids, mode, metric, rng, restarts, seed, cancel, key):
+    def on_swap(cost):
+        doc.add_next_tick_callback(partial(show_cost, "The current cost is: {:.2f}".format(cost)))
+
+    if mode == 'PAM':
+        if medoids is None:
+            # Run the greedy algorithm from several random medoids in parallel and keep the best result
+            pool, manager = process_pool()
+            try:
+                result = multi_restart(get_distances(metric), k, restarts, seed=seed, pool=pool, manager=manager,
+                                       on_swap=on_swap, cancel=cancel)
+            except BrokenProcessPool:
+                discard_process_pool(pool)
+                raise
+        else:
+            # Run the greedy algorithm for finding the optimal medoids on the precomputed distance matrix
+            result = run_k_medoids(get_distances(metric), medoids, on_swap=on_swap, cancel=cancel)
+    else:
+        # Cluster subsamples of the data and assign the full dataset to the best medoids
+        result = clara(features, k, rng, metric=metric, on_swap=on_swap, cancel=cancel)
+
+    if key is not None and not cancel.is_set():
+        results.put(key, result)
+    return result
+
 
 # implement the k-medoids algorithm in this function and hook it to the callback of the button in the dashboard
 # check the value of the select widget and use random medoids if it is set to true and use the pre-defined medoids
 # if it is set to false
 def k_medoids():
+    global job, cancel_event
+    # Only one clustering run per session at a time, further clicks are ignored until it is finished
+    if job is not None and not job.done():
+        return
+
     # number of clusters:
-    k = 3
-    # Use the following medoids if random medoid is set to false in the dashboard. These numbers are indices into the
-    # data array. If random medoids is set to true, generate random indices
+    k = int(k_select.value)
+    restarts = int(restarts_select.value)
+    # An empty seed draws new random medoids on every run, a fixed seed makes the random medoids reproducible
+    try:
+        seed = int(seed_input.value) if seed_input.value.strip() else None
+    except ValueError:
+        cluster_cost_text.text = "The seed must be an integer"
+        return
+
+    # Use evenly spread medoids if random medoid is set to false in the dashboard, for k = 3 these are the indices
+    # [24, 74, 124] into the data array. If random medoids is set to true, the random indices of every restart are
+    # generated from the seed
     if medoids_select.value == 'False':
-        medoids = [24, 74, 124]
+        rng = np.random.default_rng(0)
+        medoids = default_medoids(len(data), k)
     else:
-        rng = np.random.default_rng()
-        medoids = rng.choice(len(data), size=3, replace=False).tolist()
-
-    # Implement greedy algorithm for finding the optimal medoids
-    j_index_new = None
-    while True:
-        cost_clustering_begin = get_cost(medoids)
-        cost_clustering_end = cost_clustering_begin
-        non_medoids = [x for x in data.index.to_list() if x not in medoids]
-        medoids_index = [x for x in list(range(k)) if x not in [j_index_new]]
-        for j_index in medoids_index:
-            for i in non_medoids:
-                medoids_new = medoids.copy()
-                medoids_new[j_index] = i
-                cost_clustering_temp = get_cost(medoids_new)
-                if cost_clustering_temp < cost_clustering_end:
-                    cost_clustering_end = cost_clustering_temp
-                    j_index_new = j_index
-                    i_new = i
-        if cost_clustering_end < cost_clustering_begin:
-            medoids[j_index_new] = i_new
-        else:
-            break
-
-    # Assign colors to the data points, according to which cluster they belong to
-    dist_1 = np.linalg.norm(data.iloc[:, 0:4] - data.iloc[medoids[0], 0:4],ord=1,axis=1)
-    dist_2 = np.linalg.norm(data.iloc[:, 0:4] - data.iloc[medoids[1], 0:4],ord=1,axis=1)
-    dist_3 = np.linalg.norm(data.iloc[:, 0:4] - data.iloc[medoids[2], 0:4],ord=1,axis=1)
-    colors_list = np.argmin(np.column_stack((dist_1, dist_2, dist_3)),axis = 1).astype(str)
-    colors_list = np.where(colors_list == '0', "red", colors_list)
-    colors_list = np.where(colors_list == '1', "green", colors_list)
-    colors_list = np.where(colors_list == '2', "blue", colors_list)
-
-    # Update plots with new clustering results
-    new_data = dict(sepal_length=data['sepal_length'].tolist(),
-                    sepal_width=data['sepal_width'].tolist(),
-                    petal_length=data['petal_length'].tolist(),
-                    petal_width=data['petal_width'].tolist(),
-                    color=colors_list.tolist()
-                    )
-    source.data = new_data
+        rng = np.random.default_rng(seed)
+        medoids = None
+
+    # PAM needs the full N x N distance matrix, if it does not fit into the memory budget CLARA is used instead
+    mode = 'PAM' if mode_select.value == 'PAM' and fits_in_memory(len(data)) else 'CLARA'
+    metric = metric_select.value
+
+    # Runs are deterministic unless random medoids without a seed are used, those results are not cached
+    if medoids is not None:
+        key = (features_hash, k, metric, mode, tuple(medoids))
+    elif seed is not None:
+        key = (features_hash, k, metric, mode, 'random', seed, restarts if mode == 'PAM' else 1)
+    else:
+        key = None
+    cached = results.get(key) if key is not None else None
+    if cached is not None:
+        publish(cached)
+        return
+
+    # Submit the clustering to the worker pool, the result is published on the next tick of the session
+    cancel_event = threading.Event()
+    job = executor.submit(run_clustering, k, medoids, mode, metric, rng, restarts, seed, cancel_event, key)
+    job.add_done_callback(lambda future: doc.add_next_tick_callback(partial(show_result, future)))
+
+    cluster_button.disabled = True
+    cancel_button.disabled = False
+    cluster_cost_text.text = "Clustering ..."
+
+
+# stop the running clustering job after its current swap, the best medoids found so far are shown
+def cancel_clustering():
+    if cancel_event is not None:
+        cancel_event.set()
+
+
+# update the DIV element with the progress of the running job
+def show_cost(text):
+    if job is not None and not job.done():
+        cluster_cost_text.text = text
+
+
+# publish the result of a finished clustering job
+def show_result(future):
+    cluster_button.disabled = False
+    cancel_button.disabled = True
+    if future.exception() is not None:
+        cluster_cost_text.text = "Clustering failed: {}".format(future.exception())
+        return
+    publish(future.result(), cancelled=cancel_event.is_set())
+
+
+# show a clustering result in the plots and the DIV element
+def publish(result, cancelled=False):
+    medoids, labels, cost_clustering_end = result
+
+    # Update plots with new clustering results. Only the cluster labels are sent to the browser as a patch, the
+    # colors are assigned on the client by the color mapper and the feature columns stay untouched
+    source.patch({'label': [(slice(0, len(data)), np.asarray(labels).tolist())]})
 
     # Update DIV element with new clustering cost
-    cluster_cost_text.text = "The final cost is: {:.2f}".format(cost_clustering_end)
+    if cancelled:
+        cluster_cost_text.text = "Cancelled, the cost is: {:.2f}".format(cost_clustering_end)
+    else:
+        cluster_cost_text.text = "The final cost is: {:.2f}".format(cost_clustering_end)
 
 
 # read and store the dataset
 data = flowers.copy(deep=True)
 data = data.drop(['species'], axis=1)
 
-# create a color column in your dataframe and set it to gray on startup
-data['color'] = "gray"
+# Feature matrix used for the clustering, all numeric columns are used. The distance matrices are built on demand
+# by get_distances
+features = data.select_dtypes('number').to_numpy()
+features_hash = fingerprint(features)
+
+# create a cluster label column in your dataframe, -1 means not clustered yet and is shown in gray on startup
+data['label'] = -1
+
+# The running clustering job of this session and the event used to cancel it
+doc = curdoc()
+job = None
+cancel_event = None
 
 # Create a ColumnDataSource from the data
 source = ColumnDataSource(data)
 
 # Create a select widget, a button, a DIV to show the final clustering cost and two figures for the scatter plots.
 
+# Map the integer cluster labels to the cluster colors in the browser
+color_mapper = LinearColorMapper(palette=COLORS, low=-0.5, high=len(COLORS) - 0.5, low_color="gray")
+
 # Creating first plot
 p1 = figure(sizing_mode="scale_width")
-p1.scatter('petal_length','sepal_length',color='color', size=5,
+p1.scatter('petal_length','sepal_length',color=transform('label', color_mapper), size=5,
            line_width=1, fill_alpha=0.2,source = source)
 p1.title.text = 'Scatterplot of flower distribution by petal length and sepal length'
 p1.yaxis.axis_label = "Sepal length"
@@ -93,7 +182,7 @@ p1.xaxis.axis_label = "Petal length"
 
 # Creating second plot
 p2 = figure(sizing_mode="scale_width")
-p2.scatter('petal_width','petal_length',color='color', size=5,
+p2.scatter('petal_width','petal_length',color=transform('label', color_mapper), size=5,
            line_width=1, fill_alpha=0.2,source = source)
 p2.title.text = 'Scatterplot of flower distribution by petal width and petal length'
 p2.yaxis.axis_label = "Petal length"
@@ -102,18 +191,34 @@ p2.xaxis.axis_label = "Petal width"
 # Creating select widget
 medoids_select = Select(title='Random Medoids', value='False', options=['True', 'False'],sizing_mode="stretch_both")
 
+# Creating select widgets for the number of clusters and the clustering mode
+k_select = Select(title='Number of Clusters', value='3', options=[str(k) for k in range(2, len(COLORS) + 1)],
+                  sizing_mode="stretch_both")
+mode_select = Select(title='Mode', value='PAM', options=['PAM', 'CLARA'], sizing_mode="stretch_both")
+metric_select = Select(title='Metric', value='L1', options=METRIC_OPTIONS, sizing_mode="stretch_both")
+
+# Creating widgets for the number of random restarts, which run in parallel, and the seed of the random medoids
+restarts_select = Select(title='Random Restarts', value='1', options=['1', '2', '4', '8', '16', '32'],
+                         sizing_mode="stretch_both")
+seed_input = TextInput(title='Seed (empty for random)', value='', sizing_mode="stretch_both")
+
 # Creating cluster button and attaching k_medoids callback to it
 cluster_button = Button(label="Cluster data",sizing_mode="stretch_both")
 cluster_button.on_click(k_medoids)
 
+# Creating cancel button, it is only enabled while a clustering job is running
+cancel_button = Button(label="Cancel", disabled=True, sizing_mode="stretch_both")
+cancel_button.on_click(cancel_clustering)
+
 # Create DIV element
 cluster_cost_text = Div(text = "The final cost is: 0.00",sizing_mode="stretch_both")
 
 # use curdoc to add your widgets to the document
-lt = row(column(medoids_select,cluster_button,cluster_cost_text,sizing_mode="fixed", height = 100, width=300),
+lt = row(column(medoids_select,k_select,mode_select,metric_select,restarts_select,seed_input,cluster_button,
+                cancel_button,cluster_cost_text,sizing_mode="fixed", height = 430, width=300),
          p1,p2,sizing_mode="stretch_both")
-curdoc().add_root(lt)
-curdoc().title = "Kmedoids"
+doc.add_root(lt)
+doc.title = "Kmedoids"
 
 # use on of the commands below to start your application
 # bokeh serve --show kmedoids.py
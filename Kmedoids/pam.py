@@ -0,0 +1,348 @@
+from concurrent.futures import wait
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Headless k-medoids engine used by the dashboard in kmedoids.py.
+# The pairwise distances are computed once and every greedy pass evaluates all (medoid, non-medoid) swaps in one
+# batched step, using the distances of each point to its nearest and second nearest medoid (as done in FastPAM).
+
+# Upper bound in bytes for the temporary arrays of the blockwise distance, swap and assignment computations
+MEMORY_BUDGET = 256 * 2**20
+
+# Number of subsamples clustered by CLARA and the size of each subsample (Kaufman & Rousseeuw suggest 40 + 2k)
+CLARA_SAMPLES = 5
+CLARA_SAMPLE_SIZE = 40
+
+# Swaps whose cost changes differ by less than this many times the precision of the distance matrix, relative to the
+# cost, are treated as equally good, and a swap only counts as an improvement if it lowers the cost by more than that.
+# For the float32 matrices this is about a millionth of the cost
+SWAP_TIE_TOLERANCE = 8
+
+# Seconds between two checks for progress and cancellation while the restarts run in the process pool
+PROGRESS_INTERVAL = 0.2
+
+# Distance matrix of a restart worker process, it is attached once per process and matrix instead of once per restart
+_worker_handle = None
+_worker_distances = None
+_worker_shm = None
+
+
+# distance functions between all rows of the blocks A (a x d) and B (b x d), each returns an (a x b) array
+# The L1 distance takes the absolute values in place, so the only temporaries are the differences and their sums
+def l1_distances(A, B):
+    diff = A[:, None, :] - B[None, :, :]
+    np.abs(diff, out=diff)
+    return diff.sum(axis=2)
+
+
+def l2_distances(A, B):
+    squared = np.sum(A * A, axis=1)[:, None] + np.sum(B * B, axis=1)[None, :] - 2 * A @ B.T
+    return np.sqrt(np.maximum(squared, 0))
+
+
+def cosine_distances(A, B):
+    A = A / np.maximum(np.linalg.norm(A, axis=1), 1e-12)[:, None]
+    B = B / np.maximum(np.linalg.norm(B, axis=1), 1e-12)[:, None]
+    return np.maximum(1 - A @ B.T, 0)
+
+
+# Metrics available for the clustering. With 'precomputed', X is not a feature matrix but an N x N dissimilarity matrix
+METRICS = {'L1': l1_distances, 'L2': l2_distances, 'cosine': cosine_distances, 'precomputed': None}
+
+
+# number of rows per block such that the temporaries of a block with n_cols columns stay within the memory budget
+def block_rows(n_cols, bytes_per_entry):
+    return max(1, int(MEMORY_BUDGET // max(n_cols * bytes_per_entry, 1)))
+
+
+# bytes of temporaries per entry of a distance block, the L1 distance broadcasts over all features
+def _entry_bytes(metric, n_features):
+    return 8 * (n_features + 1) if metric == 'L1' else 8 * 3
+
+
+# whether the full N x N float32 distance matrix of n points fits into the memory budget, otherwise CLARA is used
+def fits_in_memory(n):
+    return 4 * n * n <= MEMORY_BUDGET
+
+
+def _check_metric(metric):
+    if metric not in METRICS:
+        raise ValueError("Unknown metric '{}', use one of {}".format(metric, list(METRICS)))
+
+
+# calculate the distances between all pairs of rows in X, block by block to keep the temporary arrays within the
+# memory budget. The matrix is stored as float32; if out is a file name it is written to a memory-mapped .npy file
+# instead of being kept in RAM
+def pairwise_distances(X, metric='L1', out=None):
+    _check_metric(metric)
+    if metric == 'precomputed':
+        D = np.asarray(X, dtype=np.float32)
+        if D.ndim != 2 or D.shape[0] != D.shape[1]:
+            raise ValueError("A precomputed dissimilarity must be a square matrix")
+        if out is not None:
+            D_out = np.lib.format.open_memmap(out, mode='w+', dtype=np.float32, shape=D.shape)
+            D_out[:] = D
+            return D_out
+        return D
+
+    distance = METRICS[metric]
+    X = np.asarray(X, dtype=np.float64).reshape(len(X), -1)
+    n = X.shape[0]
+    if out is None:
+        D = np.empty((n, n), dtype=np.float32)
+    else:
+        D = np.lib.format.open_memmap(out, mode='w+', dtype=np.float32, shape=(n, n))
+    rows = block_rows(n, _entry_bytes(metric, X.shape[1]))
+    for start in range(0, n, rows):
+        stop = min(start + rows, n)
+        D[start:stop] = distance(X[start:stop], X)
+    return D
+
+
+# distances between the given rows of X only, as used for the subsamples of CLARA
+def sample_distances(X, rows, metric='L1'):
+    if metric == 'precomputed':
+        return np.asarray(X[np.ix_(rows, rows)], dtype=np.float32)
+    return pairwise_distances(X[rows], metric)
+
+
+# evenly spread initial medoids, for n = 150 and k = 3 these are the indices [24, 74, 124]
+def default_medoids(n, k):
+    return [max(j * n // k + n // (2 * k) - 1, j) for j in range(k)]
+
+
+# for every point return the slot of its nearest medoid and the distances to the nearest and second nearest medoid
+def nearest_medoids(D, medoids):
+    n = D.shape[0]
+    D_med = np.asarray(D[:, medoids], dtype=np.float64)
+    nearest = np.argmin(D_med, axis=1)
+    d1 = D_med[np.arange(n), nearest]
+    if len(medoids) > 1:
+        D_med = D_med.copy()
+        D_med[np.arange(n), nearest] = np.inf
+        d2 = np.amin(D_med, axis=1)
+    else:
+        d2 = np.full(n, np.inf)
+    return nearest, d1, d2
+
+
+# change of the cost for every swap of medoid slot j with point i, returned as a (k, N) array
+# A point o moves to the candidate i if that one is closer than its nearest medoid, which does not depend on j.
+# Only if its own medoid is removed (nearest == j), o falls back to the closer of i and its second nearest medoid.
+# The candidates are processed in column blocks to keep the temporaries within the memory budget: a block holds
+# three float64 arrays of its size (the distances, shared and removed), all other steps work in place. The sums over
+# the clusters are a product with the k x N cluster membership matrix.
+def swap_deltas(D, nearest, d1, d2, k):
+    n = D.shape[0]
+    membership = np.zeros((k, n))
+    membership[nearest, np.arange(n)] = 1
+    deltas = np.empty((k, n))
+    columns = block_rows(n, 8 * 3)
+    for start in range(0, n, columns):
+        stop = min(start + columns, n)
+        D_block = np.array(D[:, start:stop], dtype=np.float64)
+        shared = np.subtract(D_block, d1[:, None])
+        np.minimum(shared, 0, out=shared)
+        removed = np.minimum(D_block, d2[:, None], out=D_block)
+        removed -= d1[:, None]
+        removed -= shared
+        deltas[:, start:stop] = membership @ removed
+        deltas[:, start:stop] += np.sum(shared, axis=0)
+    return deltas
+
+
+# greedy search for the optimal medoids, starting from the given medoids (indices into D)
+# on_swap is called with the new cost after every improving swap, and the search stops early once the cancel event
+# is set. If a stats dict is given, the number of passes and of evaluated swaps are added to it.
+# Returns the final medoids, the cluster label of every point and the final cost
+def k_medoids(D, medoids, on_swap=None, cancel=None, stats=None):
+    medoids = list(medoids)
+    k = len(medoids)
+    last_slot = None
+    while True:
+        nearest, d1, d2 = nearest_medoids(D, medoids)
+        cost = np.sum(d1)
+
+        deltas = swap_deltas(D, nearest, d1, d2, k)
+        # medoids can not be swapped with themselves, and the slot changed in the previous pass is skipped
+        deltas[:, medoids] = np.inf
+        if last_slot is not None:
+            deltas[last_slot] = np.inf
+        if stats is not None:
+            stats['passes'] = stats.get('passes', 0) + 1
+            stats['swap_evaluations'] = stats.get('swap_evaluations', 0) + int(np.sum(deltas < np.inf))
+
+        # Swaps that are tied up to rounding (the deltas are summed in a different order than in a loop over all
+        # points, and the distances may be float32) are broken like looping over both would: the first improving swap
+        # in (slot, point) order whose delta is within the tolerance of the minimum is taken. For the same reason a
+        # swap that changes the cost by less than the tolerance is no improvement
+        tolerance = SWAP_TIE_TOLERANCE * np.finfo(D.dtype).eps * max(cost, 1.0)
+        min_delta = np.min(deltas)
+        if not min_delta < -tolerance:
+            break
+        tied = (deltas <= min_delta + tolerance) & (deltas < -tolerance)
+        j, i = np.unravel_index(np.argmax(tied), deltas.shape)
+        medoids[j] = int(i)
+        last_slot = j
+
+        if on_swap is not None:
+            on_swap(cost + deltas[j, i])
+        if cancel is not None and cancel.is_set():
+            nearest, d1, _ = nearest_medoids(D, medoids)
+            cost = np.sum(d1)
+            break
+
+    return medoids, nearest, cost
+
+
+# assign every row of X to its closest medoid (indices into X) without building the full distance matrix
+# returns the cluster label of every point and the total cost
+def assign(X, medoids, metric='L1'):
+    _check_metric(metric)
+    if metric != 'precomputed':
+        X = np.asarray(X, dtype=np.float64).reshape(len(X), -1)
+        M = X[medoids]
+    n = X.shape[0]
+    labels = np.empty(n, dtype=np.int64)
+    cost = 0.0
+    rows = block_rows(len(medoids), _entry_bytes(metric, X.shape[1]))
+    for start in range(0, n, rows):
+        stop = min(start + rows, n)
+        if metric == 'precomputed':
+            D_block = np.asarray(X[start:stop, medoids], dtype=np.float64)
+        else:
+            D_block = METRICS[metric](X[start:stop], M)
+        labels[start:stop] = np.argmin(D_block, axis=1)
+        cost += np.sum(np.amin(D_block, axis=1))
+    return labels, cost
+
+
+# CLARA: cluster several random subsamples with the greedy search and keep the medoids that give the lowest cost on
+# the full dataset. Memory and runtime only depend on the sample size, apart from the linear assignment step.
+# on_swap, cancel and stats work as for k_medoids, on_swap is called whenever a sample improves the best cost
+def clara(X, k, rng, metric='L1', n_samples=CLARA_SAMPLES, sample_size=None, on_swap=None, cancel=None, stats=None):
+    _check_metric(metric)
+    if metric != 'precomputed':
+        X = np.asarray(X, dtype=np.float64).reshape(len(X), -1)
+    n = X.shape[0]
+    if sample_size is None:
+        sample_size = CLARA_SAMPLE_SIZE + 2 * k
+    sample_size = min(max(sample_size, k), n)
+
+    best = None
+    for _ in range(n_samples):
+        if best is not None and cancel is not None and cancel.is_set():
+            break
+        # the best medoids found so far are always part of the next sample
+        sample = rng.choice(n, size=sample_size, replace=False)
+        if best is not None:
+            sample = np.concatenate((best[0], sample[~np.isin(sample, best[0])]))[:sample_size]
+        sample = np.sort(sample)
+
+        medoids, _, _ = k_medoids(sample_distances(X, sample, metric), default_medoids(sample_size, k),
+                                  cancel=cancel, stats=stats)
+        medoids = sample[medoids].tolist()
+        labels, cost = assign(X, medoids, metric)
+        if best is None or cost < best[2]:
+            best = (medoids, labels, cost)
+            if on_swap is not None:
+                on_swap(cost)
+
+    return best
+
+
+# describe D for the restart workers without pickling it: a memory-mapped matrix is opened from its file, any other
+# matrix is copied into a shared memory block that is removed again when the restarts are done
+@contextmanager
+def _share(D):
+    if isinstance(D, np.memmap) and D.filename is not None:
+        yield ('memmap', D.filename, D.offset, D.shape, D.dtype.str)
+        return
+    shm = shared_memory.SharedMemory(create=True, size=max(D.nbytes, 1))
+    try:
+        np.ndarray(D.shape, dtype=D.dtype, buffer=shm.buf)[:] = D
+        yield ('shm', shm.name, 0, D.shape, D.dtype.str)
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+# open the distance matrix described by handle in a restart worker, it is kept open for the following restarts
+def _attach(handle):
+    global _worker_handle, _worker_distances, _worker_shm
+    if handle != _worker_handle:
+        _worker_distances = None
+        if _worker_shm is not None:
+            _worker_shm.close()
+            _worker_shm = None
+        kind, name, offset, shape, dtype = handle
+        if kind == 'memmap':
+            _worker_distances = np.memmap(name, dtype=dtype, mode='r', offset=offset, shape=shape)
+        else:
+            _worker_shm = shared_memory.SharedMemory(name=name)
+            _worker_distances = np.ndarray(shape, dtype=dtype, buffer=_worker_shm.buf)
+        _worker_handle = handle
+    return _worker_distances
+
+
+def _run_restart(handle, medoids, cancel, progress):
+    return k_medoids(_attach(handle), medoids, on_swap=progress.put, cancel=cancel)
+
+
+# run the greedy search from n_restarts random medoid sets and keep the solution with the lowest cost.
+# The start medoids are derived from the seed, so a fixed seed gives reproducible results; on ties the earliest
+# restart wins. The restarts run in parallel in pool, a process pool, if it is given together with a
+# multiprocessing manager; the workers get the cancel flag and report their progress through the manager.
+# on_swap is called with the lowest cost of all restarts whenever it improves. Once the cancel event is set, the
+# restarts that did not start yet are dropped and the running ones stop after their current swap.
+def multi_restart(D, k, n_restarts, seed=None, pool=None, manager=None, on_swap=None, cancel=None):
+    n = D.shape[0]
+    starts = [np.random.default_rng(s).choice(n, size=k, replace=False).tolist()
+              for s in np.random.SeedSequence(seed).spawn(n_restarts)]
+
+    best = None
+    best_index = None
+    best_cost = np.inf
+
+    def report(cost):
+        nonlocal best_cost
+        if cost < best_cost:
+            best_cost = cost
+            if on_swap is not None:
+                on_swap(cost)
+
+    def keep(index, result):
+        nonlocal best, best_index
+        if best is None or (result[2], index) < (best[2], best_index):
+            best, best_index = result, index
+            report(best[2])
+
+    if pool is None or n_restarts == 1:
+        for index, medoids in enumerate(starts):
+            keep(index, k_medoids(D, medoids, on_swap=report, cancel=cancel))
+            if cancel is not None and cancel.is_set():
+                break
+        return best
+
+    worker_cancel = manager.Event()
+    progress = manager.Queue()
+    with _share(D) as handle:
+        futures = {pool.submit(_run_restart, handle, medoids, worker_cancel, progress): index
+                   for index, medoids in enumerate(starts)}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=PROGRESS_INTERVAL)
+            while not progress.empty():
+                report(progress.get())
+            for future in done:
+                if not future.cancelled():
+                    keep(futures[future], future.result())
+            if cancel is not None and cancel.is_set() and not worker_cancel.is_set():
+                # the pool is shared, so instead of shutting it down the queued restarts are cancelled and the
+                # running ones are told to stop, they return their current medoids after at most one pass
+                worker_cancel.set()
+                for future in pending:
+                    future.cancel()
+    return best
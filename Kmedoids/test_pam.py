@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from pam import pairwise_distances, default_medoids, k_medoids, l1_distances
+
+# k_medoids has to end at the same medoids and cost as the original greedy loop of the dashboard, run with
+# python -m pytest test_pam.py
+# The features are integers, so the costs of both are exact and ties are broken the same way instead of by rounding
+
+
+# the original loop of kmedoids.py for any k: the L1 cost is recomputed for every single swap, the best swap of a pass
+# is the first one with the lowest cost in (slot, point) order, and the slot changed in the previous pass is skipped
+def reference_k_medoids(X, medoids):
+    def get_cost(meds):
+        return np.sum(np.amin(np.column_stack([np.linalg.norm(X - X[m], ord=1, axis=1) for m in meds]), axis=1))
+
+    medoids = list(medoids)
+    k = len(medoids)
+    j_index_new = None
+    while True:
+        cost_clustering_begin = get_cost(medoids)
+        cost_clustering_end = cost_clustering_begin
+        non_medoids = [x for x in range(len(X)) if x not in medoids]
+        medoids_index = [x for x in range(k) if x not in [j_index_new]]
+        for j_index in medoids_index:
+            for i in non_medoids:
+                medoids_new = medoids.copy()
+                medoids_new[j_index] = i
+                cost_clustering_temp = get_cost(medoids_new)
+                if cost_clustering_temp < cost_clustering_end:
+                    cost_clustering_end = cost_clustering_temp
+                    j_index_new = j_index
+                    i_new = i
+        if cost_clustering_end < cost_clustering_begin:
+            medoids[j_index_new] = i_new
+        else:
+            break
+    return medoids, cost_clustering_end
+
+
+def assert_same_result(X, medoids, D=None):
+    if D is None:
+        D = pairwise_distances(X, 'L1')
+    result_medoids, _, result_cost = k_medoids(D, medoids)
+    reference_medoids, reference_cost = reference_k_medoids(X, medoids)
+    assert result_medoids == reference_medoids
+    assert result_cost == pytest.approx(reference_cost, rel=1e-5)
+
+
+def test_iris():
+    try:
+        from bokeh.sampledata.iris import flowers
+    except (ImportError, RuntimeError):
+        pytest.skip("the Bokeh sample data is not installed")
+    # the measurements in tenths of a centimeter, which are integers
+    X = np.round(flowers.drop(['species'], axis=1).to_numpy(dtype=np.float64) * 10)
+    for k in range(2, 6):
+        assert_same_result(X, default_medoids(len(X), k))
+    rng = np.random.default_rng(0)
+    for k in range(3, 8):
+        assert_same_result(X, rng.choice(len(X), size=k, replace=False).tolist())
+
+
+# small integer features, many swaps have exactly the same cost
+@pytest.mark.parametrize('seed', range(25))
+def test_ties(seed):
+    rng = np.random.default_rng(seed)
+    n, d, k = int(rng.integers(20, 60)), int(rng.integers(1, 4)), int(rng.integers(2, 6))
+    X = rng.integers(0, 4, size=(n, d)).astype(np.float64)
+    assert_same_result(X, rng.choice(n, size=k, replace=False).tolist())
+
+
+# integer features from a wide range, few swaps have the same cost. The float32 distances of the dashboard only tell
+# swaps apart up to about a millionth of the cost, so the search is compared on a float64 distance matrix
+@pytest.mark.parametrize('seed', range(25))
+def test_spread(seed):
+    rng = np.random.default_rng(seed)
+    n, d, k = int(rng.integers(20, 60)), int(rng.integers(1, 5)), int(rng.integers(2, 6))
+    X = rng.integers(0, 10**6, size=(n, d)).astype(np.float64)
+    assert_same_result(X, rng.choice(n, size=k, replace=False).tolist(), D=l1_distances(X, X))
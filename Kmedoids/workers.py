@@ -0,0 +1,48 @@
+import multiprocessing
+import os
+import site
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Worker pool for the clustering runs of the dashboard. Bokeh executes kmedoids.py again for every browser session,
+# but imported modules are only loaded once, so all sessions of a server process share this pool and the Bokeh event
+# loop is never blocked by a clustering run. NumPy releases the GIL for the heavy array operations.
+MAX_WORKERS = max(1, (os.cpu_count() or 1) - 1)
+
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="kmedoids")
+
+# The random restarts run in a process pool that is shared the same way. Its workers are started by a fork server
+# (or spawned where there is none) instead of being forked from a thread of the running Bokeh server.
+MP_CONTEXT = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+                                         else 'spawn')
+
+# Folder of the dashboard. The workers import pam.py from it, but Bokeh only puts it on sys.path while it runs the app
+# code, so every worker adds it before it takes its first task
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_process_pool = None
+_manager = None
+_lock = threading.Lock()
+
+
+# the process pool for the restarts and the multiprocessing manager for their cancel flags and progress reports,
+# both are started on first use
+def process_pool():
+    global _process_pool, _manager
+    with _lock:
+        if _process_pool is None:
+            if _manager is None:
+                _manager = MP_CONTEXT.Manager()
+            _process_pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=MP_CONTEXT,
+                                                initializer=site.addsitedir, initargs=(APP_DIR,))
+        return _process_pool, _manager
+
+
+# drop a process pool that is broken, e.g. because a worker was killed, so the next run starts a new one instead of
+# failing as well
+def discard_process_pool(pool):
+    global _process_pool
+    with _lock:
+        if _process_pool is pool:
+            _process_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
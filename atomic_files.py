@@ -0,0 +1,47 @@
+import os
+import tempfile
+import zipfile
+from contextlib import contextmanager
+
+import numpy as np
+
+
+# ==========================================================================
+# Cache files shared by the apps of this repository
+# A cache file is written to a temporary file in the same directory, which is
+# renamed to its final name once it is complete. Readers never see a half
+# written file, and the temporary names are unique, so several server
+# processes (bokeh serve --num-procs) can write the same cache at once.
+# ==========================================================================
+
+
+# yield a temporary file name next to path, the file written to it replaces path when the block ends without error
+@contextmanager
+def replace_atomically(path):
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    os.close(fd)
+    try:
+        yield tmp_file
+        os.replace(tmp_file, path)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+# write arrays to an .npz file with replace_atomically
+def write_npz(path, **arrays):
+    with replace_atomically(path) as tmp_file:
+        with open(tmp_file, "wb") as f:
+            np.savez(f, **arrays)
+
+
+# all arrays of an .npz file, or None if it is missing or unreadable
+def read_npz(path):
+    try:
+        with np.load(path) as store:
+            return {name: store[name] for name in store.files}
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        return None
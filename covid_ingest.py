@@ -0,0 +1,90 @@
+import hashlib
+import io
+import os
+import urllib.request
+
+import pandas as pd
+
+from atomic_files import replace_atomically
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+# ==========================================================================
+# Ingest layer for the Covid CSV files of the Interactivity exercises
+# The files are parsed with explicit dtypes and vectorized date parsing, and
+# the parsed frame is cached as a Parquet file, keyed by the hash of the file
+# content and the parse options. The cache is only rebuilt when the file
+# changes. Without pyarrow the files are parsed every time.
+# ==========================================================================
+
+# Directory of the Parquet files
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+
+# Format of the dates in the Covid data sets
+DATE_FORMAT = '%Y-%m-%d'
+
+
+# the raw bytes of a local file or a URL
+def _read_bytes(source):
+    if '://' in source:
+        with urllib.request.urlopen(source) as response:
+            return response.read()
+    with open(source, 'rb') as f:
+        return f.read()
+
+
+# parse CSV bytes. dtype maps column names to dtypes, all other columns get default_dtype if it is given. The columns
+# in dates, and the index if date_index is set, are parsed as dates in DATE_FORMAT
+def parse(data, dtype=None, default_dtype=None, dates=(), index_col=None, date_index=False):
+    names = pd.read_csv(io.BytesIO(data), nrows=0).columns.tolist()
+    index_name = names[index_col] if isinstance(index_col, int) else index_col
+    column_dtype = {}
+    for name in names:
+        if name == index_name or name in dates:
+            column_dtype[name] = str
+        elif dtype is not None and name in dtype:
+            column_dtype[name] = dtype[name]
+        elif default_dtype is not None:
+            column_dtype[name] = default_dtype
+
+    df = pd.read_csv(io.BytesIO(data), dtype=column_dtype, index_col=index_col)
+    for name in dates:
+        df[name] = pd.to_datetime(df[name], format=DATE_FORMAT)
+    if date_index:
+        df.index = pd.to_datetime(df.index, format=DATE_FORMAT)
+    return df
+
+
+# read a CSV file or URL through the Parquet cache, the arguments of parse are the parse options. The number of bytes
+# that were read is stored in df.attrs['n_bytes'], so a reader can continue at the end of the file. With complete_lines,
+# a partially written last line of a file that is still appended to is left for that reader, like in feed.CsvTail
+def load(source, complete_lines=False, **options):
+    data = _read_bytes(source)
+    if complete_lines:
+        data = data[:data.rfind(b'\n') + 1]
+    if pyarrow is None:
+        df = parse(data, **options)
+        df.attrs['n_bytes'] = len(data)
+        return df
+
+    digest = hashlib.sha1(data)
+    digest.update(repr(sorted(options.items())).encode())
+    name = os.path.basename(source.split('?')[0])
+    cache_file = os.path.join(CACHE_DIR, f"{name}.{digest.hexdigest()[:16]}.parquet")
+    try:
+        df = pd.read_parquet(cache_file)
+    except (OSError, ValueError):
+        df = parse(data, **options)
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # drop the cache of older versions of the file
+        for old_file in os.listdir(CACHE_DIR):
+            if old_file.startswith(name + ".") and old_file.endswith(".parquet"):
+                os.remove(os.path.join(CACHE_DIR, old_file))
+        with replace_atomically(cache_file) as tmp_file:
+            df.to_parquet(tmp_file)
+    df.attrs['n_bytes'] = len(data)
+    return df